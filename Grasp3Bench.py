@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## benchmarks for Grasp3Server2's hot paths, written out as JSON so runs can be compared across releases
+#  runs against a scratch copy of the shape db and Grasp3Sim's simulated PLCs, so it needs no hardware
+#  and leaves the real db alone
+#
+#    python Grasp3Bench.py --db Grasp3Shapes.db --out bench.json
+#    python Grasp3Bench.py --quick      # fewer repeats, for a smoke test
+#
+#  covers:
+#    hexArrays   create_hex_array time and size across display radii
+#    generation  create_shape (generate + insert) and generate_shape alone, plus batch throughput
+#    rendering   register frames and modeled bus time per shape, full and diff redraws
+#    routes      p50/p99 latency of /shape, /display and /set_piston through Flask's test client
+#    fanout      time from a broadcast to every one of N real websocket clients having the state
+#  times are in milliseconds. Bus time is what the simulated wire would have taken at the PLCs' baud,
+#  the server doesn't actually wait for it (timeScale=0) so the other timings are just our own overhead
+
+import os, sys, json, time, shutil, tempfile, argparse, platform, subprocess, threading, contextlib, io, logging
+import numpy as np
+
+
+def stats(seconds):
+    # summary of a list of timings, in ms
+    ms = np.array(seconds, dtype=float) * 1e3
+    if not len(ms):
+        return dict(n=0)
+    return dict(n=len(ms), mean=float(ms.mean()), p50=float(np.percentile(ms, 50)),
+                p99=float(np.percentile(ms, 99)), max=float(ms.max()))
+
+def spread(values):
+    # summary of a list of counts
+    values = np.array(values, dtype=float)
+    return dict(n=len(values), mean=float(values.mean()), p50=float(np.percentile(values, 50)), max=float(values.max()))
+
+def quiet():
+    # the server prints as it goes, keep that out of the way of the results
+    return contextlib.redirect_stdout(io.StringIO())
+
+def progress(text):
+    print(text, file=sys.stderr, flush=True)
+
+
+def bench_hex_arrays(g3, radii):
+    results, displayIDs = [], {}
+    for rMax in radii:
+        with quiet():
+            t0 = time.perf_counter()
+            displayID = g3.create_hex_array(5, 7, rMax, 1.1, 3.4)
+            seconds = time.perf_counter() - t0
+        routing = g3.get_routing(displayID)
+        displayIDs[rMax] = displayID
+        results.append(dict(rMax=rMax, nPins=routing.nPins, nPLCs=int(routing.nPLCs), ms=seconds * 1e3))
+    return results, displayIDs
+
+
+def bench_generation(g3, displayID, n):
+    geometry = g3.shape_geometry(displayID)
+    rng = np.random.default_rng(0)
+    generate = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        g3.generate_shape(geometry, rng)
+        generate.append(time.perf_counter() - t0)
+
+    create, shapeIDs = [], []
+    with quiet():
+        for i in range(n):
+            t0 = time.perf_counter()
+            shapeIDs.append(g3.create_shape(displayID))
+            create.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        g3.create_shapes(displayID, n * 10, seed=0)
+        batch = time.perf_counter() - t0
+
+    return dict(displayID=displayID, generate_shape=stats(generate), create_shape=stats(create),
+                create_shapes=dict(n=n * 10, ms=batch * 1e3, shapesPerSecond=n * 10 / batch)), shapeIDs
+
+
+def bench_rendering(g3, sim, displayID, shapeIDs):
+    # frames, timeouts and modeled seconds, summed over every simulated bus, for one set_pistons_to_shape
+    def counters():
+        buses = list(sim.simBuses.values())
+        return np.array([sum([b.frames for b in buses]), sum([b.busySeconds for b in buses]),
+                         sum([b.timeouts for b in buses])])
+
+    results = {}
+    for mode in ('full', 'diff'):
+        frames, busSeconds, wall = [], [], []
+        timeouts = 0
+        g3.forget_PLC_state()
+        for shapeID in shapeIDs:
+            pistons, shapeDisplay = g3.load_shape(shapeID)
+            before = counters()
+            with quiet():
+                t0 = time.perf_counter()
+                g3.set_pistons_to_shape(pistons, shapeDisplay, force=mode == 'full')
+                wall.append(time.perf_counter() - t0)
+            delta = counters() - before
+            frames.append(delta[0])
+            busSeconds.append(delta[1])
+            timeouts += int(delta[2])
+        results[mode] = dict(frames=spread(frames), busTime=stats(busSeconds), serverTime=stats(wall), timeouts=timeouts)
+    results['nPins'] = g3.get_routing(displayID).nPins
+    results['planCache'] = dict(g3.planStats)
+    return results
+
+
+def bench_routes(g3, displayID, shapeIDs, n):
+    client = g3.app.test_client()
+    routing = g3.get_routing(displayID)
+    rng = np.random.default_rng(1)
+
+    def timed(urls):
+        seconds = []
+        with quiet():
+            for url in urls:
+                t0 = time.perf_counter()
+                response = client.get(url)
+                seconds.append(time.perf_counter() - t0)
+                if response.status_code != 200:
+                    raise RuntimeError(url + ' returned ' + str(response.status_code))
+        return stats(seconds)
+
+    return {'/shape': timed(['/shape/' + str(shapeIDs[i % len(shapeIDs)]) for i in range(n)]),
+            '/display': timed(['/display/' + str(displayID) + '/1'] * n),
+            '/set_piston': timed(['/set_piston/' + str(displayID) + '/' + str(int(rng.choice(routing.piston))) + '/' + str(i % 2)
+                                  for i in range(n)])}
+
+
+def bench_fanout(g3, displayID, shapeIDs, counts, rounds):
+    ## real websocket clients on a real (local) server, timed from the broadcast to each client's receive
+    from werkzeug.serving import make_server
+    import simple_websocket
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)   # no access log line per websocket
+    server = make_server('127.0.0.1', 0, g3.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'ws://127.0.0.1:' + str(server.server_port) + '/'
+    with quiet():
+        g3.show_display(displayID, 0)
+        g3.show_shape(shapeIDs[0])
+
+    results = []
+    try:
+        for n in counts:
+            received = []   # perf_counter of every state message that arrived
+            cond = threading.Condition()
+            sockets = [simple_websocket.Client.connect(url) for i in range(n)]
+            for ws in sockets:
+                ws.receive(timeout=5)   # the welcome state
+
+            def reader(ws):
+                while True:
+                    try:
+                        ws.receive()
+                    except Exception:
+                        return
+                    with cond:
+                        received.append(time.perf_counter())
+                        cond.notify()
+            for ws in sockets:
+                threading.Thread(target=reader, args=(ws,), daemon=True).start()
+
+            latest, everyone = [], []
+            with quiet():
+                for r in range(rounds):
+                    with cond:
+                        del received[:]
+                    g3.put_shape(shapeIDs[r % len(shapeIDs)])
+                    t0 = time.perf_counter()
+                    g3.broadcastDisplay()
+                    with cond:
+                        if not cond.wait_for(lambda: len(received) >= n, timeout=10):
+                            raise RuntimeError('only ' + str(len(received)) + ' of ' + str(n) + ' clients got the broadcast')
+                        arrived = np.array(received[:n]) - t0
+                    latest.append(arrived.max())
+                    everyone.extend(arrived)
+            results.append(dict(clients=n, perClient=stats(everyone), lastClient=stats(latest)))
+            for ws in sockets:
+                ws.close()
+            for i in range(100):   # let the server notice before the next round's clients connect
+                if not g3.hub.snapshot():
+                    break
+                time.sleep(0.05)
+    finally:
+        server.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Grasp3Server2 against a copy of the shape db and simulated PLCs')
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Grasp3Shapes.db'),
+                        help='shape db to copy and benchmark against (not modified)')
+    parser.add_argument('--out', help='write the JSON results here instead of stdout')
+    parser.add_argument('--sim', default='latency=0.005', help='Grasp3Sim options, see Grasp3Sim.py')
+    parser.add_argument('--radii', default='10,15,20,25', help='display rMax values for create_hex_array')
+    parser.add_argument('--clients', default='1,10,50,200', help='websocket client counts for the fan-out test')
+    parser.add_argument('--quick', action='store_true', help='fewer repeats, for a smoke test')
+    args = parser.parse_args()
+
+    n = 20 if args.quick else 200
+    rounds = 5 if args.quick else 50
+    radii = [float(r) for r in args.radii.split(',')]
+
+    # everything below runs on a scratch copy of the db and the simulated bus, never the real ones
+    scratch = tempfile.mkdtemp(prefix='grasp3bench')
+    os.makedirs(os.path.join(scratch, 'db_backup'))
+    shutil.copy(args.db, os.path.join(scratch, 'Grasp3Shapes.db'))
+    os.environ['GRASP3_DB'] = os.path.join(scratch, 'Grasp3Shapes.db')
+    os.environ['GRASP3_SIM'] = args.sim + ',timeScale=0'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with quiet():
+        import Grasp3Server2 as g3
+        import Grasp3Sim as sim
+
+    results = dict(meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), commit=git_commit(), python=platform.python_version(),
+                             numpy=np.__version__, platform=platform.platform(), sim=args.sim, quick=args.quick))
+    try:
+        progress('create_hex_array...')
+        results['hexArrays'], displayIDs = bench_hex_arrays(g3, radii)
+        displayID = displayIDs[max(radii)]
+
+        progress('shape generation...')
+        results['generation'], shapeIDs = bench_generation(g3, displayID, n)
+
+        progress('rendering...')
+        results['rendering'] = bench_rendering(g3, sim, displayID, shapeIDs)
+
+        progress('routes...')
+        results['routes'] = bench_routes(g3, displayID, shapeIDs, n)
+
+        progress('websocket fan-out...')
+        results['fanout'] = bench_fanout(g3, displayID, shapeIDs, [int(c) for c in args.clients.split(',')], rounds)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    text = json.dumps(results, indent=1)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,163 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import sqlite3, time, random, math, os, binascii, re
+import sqlite3, time, random, math, os, binascii, re, threading, atexit, base64, bisect, contextlib, gzip, hashlib, struct, zlib, tempfile, shutil
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.collections as mc
-from flask import Flask, url_for, request, jsonify
+from flask import Flask, url_for, request, jsonify, Response, stream_with_context
 import asyncio
 from flask_sock import Sock
 # import websockets
 # from flask_socketio import SocketIO
-import json
+import json, collections
+from concurrent.futures import ThreadPoolExecutor
 from pymodbus.client import ModbusSerialClient
+import Grasp3Sim
 
 
-dbFile = "/Users/ryanlloydmiller/Grasp3Code/Grasp3Shapes.db"
+dbFile = os.environ.get('GRASP3_DB', "/Users/ryanlloydmiller/Grasp3Code/Grasp3Shapes.db")  # GRASP3_DB points at another db, e.g. a scratch copy
 # rs485Converter = '/dev/cu.usbserial-A10MIFNZ'
 rs485Converter = '/dev/cu.usbserial-A10N7O4I'  #found using ls /dev/cu.*
-socketConns=[]  # list of socket connection objects, 1 for each active client
+simConfig = os.environ.get('GRASP3_SIM')  # set to drive Grasp3Sim's simulated PLCs instead of the converters, see Grasp3Sim.py
+rs485Buses = {}    # PLC ID -> converter port, for PLCs that aren't on rs485Converter. each port is its own bus
+shapeDeadline = 2. # seconds a shape redraw gets across all buses, PLCs not reached by then are skipped
 
 activeDisplay = 0  # id number(s) of active display, useful for when client connects and needs to know status
 activeShape = 0    # if we're using preset shapes (not individual pistons) this should hold that value
-activePistons = '0' # string of 0s and 1s that holds status of all pistons
+activePistons = None # PackedShape that holds status of all pistons, None until we know
+stateSeq = 0       # bumped on every broadcast state, lets protocol 2 websocket clients spot missed deltas
+lastState = None   # (activeDisplay, activeShape, activePistons) as of the last broadcast, what deltas are taken against and snapshots are made from
+stateLock = threading.Lock()
+shapeGeometry = {} # displayID -> (neighbors, outward, alwaysUpIndices) used by create_shape
+routingCache = {}  # displayID -> DisplayRouting
+shapeIndexes = {}  # displayID -> ShapeIndex, for similarity searches
+geometryCache = {} # displayID -> DisplayGeometry, the /display response ready to send
 chansEach = 32 #chans available on each PLC
+bulkWrites = True  # write a PLC's channel registers with one function 16 request when that's cheaper
+noBulkPLCs = set() # PLC IDs whose firmware rejected function 16, these always get single register writes
+frameGap = 0.005   # seconds of turnaround assumed per Modbus transaction when comparing write strategies
+plcState = {}      # PLC ID -> (up, known) bool arrays indexed by channel, what we last successfully told each PLC
+lastRedraw = {}    # timing of the most recent set_pistons_to_shape
+sequenceLead = 0.05 # seconds between a sequence starting and its first onset, so step 0 isn't late
+spinWindow = 0.002  # the scheduler sleeps until this close to an onset, then spins on the clock
+planCacheSize = 4096 # PLC write plans kept by cached_plan, least recently used go first
+shapeCacheSize = 512 # shapes kept by load_shape
+prefetchAhead = 2   # after a shape is shown, plan this many of the display's next shapes in the background
+minShapeDistance = 0 # new shapes must differ from every stored shape on their display by at least this many pistons, 0 allows repeats
+toggleWindow = float(os.environ.get('GRASP3_TOGGLE_WINDOW', 0))  # seconds set_piston waits to merge toggles into one write per PLC, 0 writes each straight away
+maxHexRings = 300  # largest display layout_hex_array will work out, in rings of pistons (~270k pistons)
+backupDir = os.path.join(os.path.dirname(dbFile), 'db_backup')  # where snapshots of the db go
+backupKeep = int(os.environ.get('GRASP3_BACKUP_KEEP', 20))   # newest snapshots always kept
+backupDays = int(os.environ.get('GRASP3_BACKUP_DAYS', 30))   # beyond those, keep the last snapshot of each day for this many days
+backupEvery = float(os.environ.get('GRASP3_BACKUP_EVERY', 0)) # seconds between automatic snapshots, 0 for none
+backupPages = 256   # db pages a snapshot copies per step, writers only ever wait for one step
+previewDir = os.path.join(os.path.dirname(dbFile), 'previews')  # rendered shape previews, see shape_preview
+previewFormats = {'png': 'image/png', 'svg': 'image/svg+xml'}
 
 app = Flask(__name__)
 sock = Sock(app)
 
-global dest
+dest = None                   # in-memory replica of dbFile that all reads go to
+destLock = threading.RLock()  # held by readers for a query and by writers while they update the replica
+dbLock = threading.RLock()    # one writer at a time, so disk and replica see changes in the same order
+
+
+class Metrics:
+    ## counters and latency histograms for /metrics
+    #  names can carry labels, e.g. count('modbus_errors', plc=3). histograms have fixed buckets
+    #  (seconds, upper bounds) so observing is a bisect and an add. With enabled False every call
+    #  returns straight away, set GRASP3_METRICS=0 to start that way
+    
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., float('inf'))
+    
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()   # (name, labels) -> count
+        self.histograms = {}                    # (name, labels) -> [bucket counts, sum, count]
+        self.started = time.time()
+    
+    def count(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[self.key(name, labels)] += n
+    
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(self.buckets), 0., 0]
+            hist[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            hist[1] += seconds
+            hist[2] += 1
+    
+    def timer(self, name, **labels):
+        # with metrics.timer('x'): ... observes how long the block took
+        return MetricsTimer(self, name, labels) if self.enabled else nullTimer
+    
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+    
+    @staticmethod
+    def key(name, labels):
+        # label values are kept as strings, so keys always sort whatever types callers passed
+        return (name, tuple(sorted([(k, str(v)) for k, v in labels.items()])))
+    
+    @staticmethod
+    def key_name(key):
+        # 'name{label=value,...}'
+        name, labels = key
+        return name + ('{' + ','.join([k + '=' + str(v) for k, v in labels]) + '}' if labels else '')
+    
+    def snapshot(self):
+        # everything as plain dicts, histogram buckets cumulative and keyed by upper bound
+        with self.lock:
+            counters = {self.key_name(key): n for key, n in sorted(self.counters.items())}
+            histograms = {}
+            for key, (counts, total, n) in sorted(self.histograms.items()):
+                histograms[self.key_name(key)] = dict(count=n, sum=total, mean=total / n if n else 0.,
+                    buckets={str(le): int(c) for le, c in zip(self.buckets, np.cumsum(counts))})
+        return dict(enabled=self.enabled, since=self.started, counters=counters, histograms=histograms)
+    
+    def prometheus(self):
+        # the same numbers in Prometheus' text format
+        def labelText(labels, extra=()):
+            labels = list(labels) + list(extra)
+            return '{' + ','.join([k + '="' + str(v) + '"' for k, v in labels]) + '}' if labels else ''
+        lines = []
+        with self.lock:
+            for (name, labels), n in sorted(self.counters.items()):
+                lines.append('grasp3_' + name + '_total' + labelText(labels) + ' ' + str(n))
+            for (name, labels), (counts, total, n) in sorted(self.histograms.items()):
+                for le, c in zip(self.buckets, np.cumsum(counts)):
+                    lines.append('grasp3_' + name + '_bucket' + labelText(labels, [('le', '+Inf' if le == float('inf') else le)]) + ' ' + str(c))
+                lines.append('grasp3_' + name + '_sum' + labelText(labels) + ' ' + repr(total))
+                lines.append('grasp3_' + name + '_count' + labelText(labels) + ' ' + str(n))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsTimer:
+    def __init__(self, metrics, name, labels):
+        self.metrics, self.name, self.labels = metrics, name, labels
+    
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.t0, **self.labels)
+        return False
+
+nullTimer = contextlib.nullcontext()
+metrics = Metrics(os.environ.get('GRASP3_METRICS', '1') != '0')
 
 
 
@@ -38,13 +168,148 @@ def chk_conn_db(conn):
       except Exception as ex:
         return False
 
-def connect_RS485(baud=19200):
-    client = ModbusSerialClient(method='rtu', port=rs485Converter, baudrate=baud, bytesize=8, parity='N', stopbits=1)
-    client.connect() # should return true
+def connect_RS485(baud=19200, port=None):
+    # opens a new client on the converter, use the pooled rs485 bus below for normal traffic
+    with metrics.timer('rs485_connect_seconds'):
+        if simConfig is not None:
+            client = Grasp3Sim.SimClient(method='rtu', port=port or rs485Converter, baudrate=baud, **Grasp3Sim.parse_config(simConfig))
+        else:
+            client = ModbusSerialClient(method='rtu', port=port or rs485Converter, baudrate=baud, bytesize=8, parity='N', stopbits=1)
+        client.connect() # should return true
     if client.is_socket_open():
+        metrics.count('rs485_connects', result='ok')
         return client
     else:
+        metrics.count('rs485_connects', result='failed')
         return False    
+
+
+class RS485Bus:
+    ## Long-lived Modbus RTU client for one RS485 converter
+    #  the port is opened once and kept open; if it drops we reopen it with exponential backoff
+    #  the lock serializes the bus so Flask worker threads never interleave frames
+    #  hold bus.lock around a run of writes (e.g. a whole shape) to keep other threads off the bus
+    
+    def __init__(self, port, baud=19200, backoffMin=0.5, backoffMax=30.):
+        self.port = port
+        self.baud = baud
+        self.backoffMin = backoffMin
+        self.backoffMax = backoffMax
+        self.lock = threading.RLock()
+        self.client = None
+        self.backoff = backoffMin
+        self.nextAttempt = 0.    # monotonic time before which we won't try to reopen the port
+        self.failures = 0        # consecutive failed opens / dropped connections
+        self.opens = 0           # number of times the port has been opened
+        self.errors = 0          # modbus error responses (bus was fine, PLC said no or didn't answer)
+        self.lastError = ''
+        self.lastOK = None       # wall-clock time of the last successful open or write
+    
+    def _failed(self, err):
+        # drop the client and push the next reconnect attempt out
+        self.failures += 1
+        self.lastError = err
+        print('RS485 ' + self.port + ': ' + err)
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+            self.client = None
+        self.nextAttempt = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.backoffMax)
+    
+    def is_open(self):
+        # make sure the port is open, reopening it if we're past the backoff window
+        # cheap when the port is already open, nothing goes out on the bus
+        with self.lock:
+            if self.client is not None:
+                return True
+            if time.monotonic() < self.nextAttempt:
+                return False
+            try:
+                client = connect_RS485(self.baud, self.port)
+            except Exception as ex:
+                client = False
+                err = str(ex)
+            else:
+                err = 'failed to open port'
+            if not client:
+                self._failed(err)
+                return False
+            self.client = client
+            self.failures = 0
+            self.opens += 1
+            self.backoff = self.backoffMin
+            self.lastOK = time.time()
+            return True
+    
+    def _send(self, method, address, value, unit):
+        # returns the pymodbus result, or None if we couldn't get the frame onto the bus
+        with self.lock:
+            if not self.is_open():
+                return None
+            t0 = time.perf_counter()
+            try:
+                result = getattr(self.client, method)(int(address), value, unit=int(unit))
+            except Exception as ex:
+                metrics.count('modbus_lost', plc=int(unit))
+                self._failed(str(ex))
+                return None
+            metrics.observe('modbus_write_seconds', time.perf_counter() - t0, method=method)
+            metrics.count('modbus_writes', plc=int(unit))
+            if result.isError():
+                metrics.count('modbus_errors', plc=int(unit))
+                self.errors += 1
+                self.lastError = str(result)
+                if not self.client.is_socket_open():
+                    self._failed('port closed during write')
+            else:
+                self.lastOK = time.time()
+            return result
+    
+    def write_register(self, address, value, unit):
+        return self._send('write_register', address, int(value), unit)
+    
+    def write_registers(self, address, values, unit):
+        # function 16, consecutive registers starting at address in one transaction
+        return self._send('write_registers', address, [int(v) for v in values], unit)
+    
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+    
+    def status(self):
+        # connection health from what we already know, doesn't touch the port
+        return {'port': self.port, 'baud': self.baud, 'connected': self.client is not None,
+                'failures': self.failures, 'opens': self.opens, 'errors': self.errors,
+                'lastError': self.lastError, 'lastOK': self.lastOK,
+                'retryIn': max(0., self.nextAttempt - time.monotonic()) if self.client is None else 0.}
+
+
+buses = {}         # port -> RS485Bus, one per converter
+busesLock = threading.Lock()
+busPool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='rs485')  # drives the buses in parallel during a redraw
+
+def get_bus(PLC=None):
+    # the bus a PLC hangs off, or the default converter's bus
+    port = rs485Buses.get(int(PLC), rs485Converter) if PLC is not None else rs485Converter
+    with busesLock:
+        if port not in buses:
+            buses[port] = RS485Bus(port)
+        return buses[port]
+
+def close_buses():
+    for bus in list(buses.values()):
+        bus.close()
+
+rs485 = get_bus()
+for PLC in rs485Buses:
+    get_bus(PLC)
+atexit.register(close_buses)
+
     
 def change_PLC_baud(unitID, oldBaud = 9600, newBaud = 19200):
     # default is 9600 but I want 19200
@@ -54,8 +319,16 @@ def change_PLC_baud(unitID, oldBaud = 9600, newBaud = 19200):
     elif newBaud == 9600:
         val = 3
     
-    client = connect_RS485(baud=oldBaud)
-    result = client.write_register(address=254, value=val, unit=unitID)
+    # the port can only be open once, so borrow it from the pooled bus while we talk at the old baud
+    bus = get_bus(unitID)
+    with bus.lock:
+        bus.close()
+        client = connect_RS485(baud=oldBaud, port=bus.port)
+        if not client:
+            print('failed to connect to modem')
+            return
+        result = client.write_register(address=254, value=val, unit=unitID)
+        client.close()
 
     if result.isError():
         print('baud change failed')
@@ -70,16 +343,64 @@ def set_all_pistons(plcID, direction):
     elif str(direction) == '0':
         val = 2048
         
-    client = connect_RS485()
-    client.write_register(address=1, value=val, unit=int(plcID))
-    client.close() # not clear what this does
+    write_PLC(int(plcID), [(1, val)])
     
     response = jsonify(PLCChan=json.dumps('all'))
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
         
         
-def set_pistons_to_shape(shape, displayID):
+class DisplayRouting:
+    ## a display's piston addresses compiled into arrays, so rendering and toggling need no SQL
+    #  plc and chan are in piston order (bit i of a shape is piston i); order lists piston indices
+    #  grouped by PLC, with PLC_IDs[k]'s pistons at order[offsets[k]:offsets[k+1]]
+    
+    def __init__(self, rows, props):
+        rows = np.array(rows, dtype=np.int32).reshape(-1, 3)
+        self.piston = np.ascontiguousarray(rows[:, 0])   # piston numbers from the db, sorted
+        self.plc = np.ascontiguousarray(rows[:, 1])
+        self.chan = np.ascontiguousarray(rows[:, 2])
+        self.nPins = len(rows)
+        self.order = np.argsort(self.plc, kind='stable')
+        self.PLC_IDs, starts = np.unique(self.plc[self.order], return_index=True)
+        self.offsets = np.append(starts, self.nPins)
+        self.groups = {int(PLC): k for k, PLC in enumerate(self.PLC_IDs)}
+        self.nPLCs, self.vacPLC, self.vacChan = props
+    
+    def pistons_on(self, PLC):
+        # indices (into plc/chan/shape) of the pistons wired to this PLC
+        k = self.groups[int(PLC)]
+        return self.order[self.offsets[k]:self.offsets[k+1]]
+    
+    def index_of(self, piston):
+        # index of a piston number, or None if it's not on this display
+        i = np.searchsorted(self.piston, int(piston))
+        return int(i) if i < self.nPins and self.piston[i] == int(piston) else None
+    
+    def address(self, piston):
+        # (PLC, chan) for a piston number, -1 is the vacuum channel
+        if int(piston) == -1:
+            return (self.vacPLC, self.vacChan) if self.vacPLC is not None else None
+        i = self.index_of(piston)
+        return (int(self.plc[i]), int(self.chan[i])) if i is not None else None
+
+
+def get_routing(displayID):
+    # compiled routing for a display, built on first use and dropped by forget_display_caches
+    displayID = int(displayID)
+    routing = routingCache.get(displayID)
+    if routing is None:
+        rows = query("SELECT piston, PLC_ID, PLC_Chan FROM pistonAddressesTable WHERE DisplayID=? ORDER BY piston", (displayID,))
+        props = query("SELECT nPLCs, vacPLC, vacChan FROM displayPropsTable WHERE DisplayID=?", (displayID,))
+        if not rows or not props:
+            return None
+        routing = routingCache[displayID] = DisplayRouting(rows, props[0])
+    return routing
+
+
+def set_pistons_to_shape(shape, displayID, force=False):
+    ## drive the display's PLCs to the shape (PackedShape, or string of 0s and 1s, one per piston)
+    #  only channels that differ from the last known PLC state are written, unless force is set
     global activeShape, chansEach
     
     # error checking on input
@@ -90,236 +411,822 @@ def set_pistons_to_shape(shape, displayID):
     
     
     # Get the addresses of the relevant pistons
-    cmd = f"SELECT PLC_ID, PLC_Chan FROM pistonAddressesTable WHERE DisplayID={displayID}"
-    res = dest.execute(cmd).fetchall()
-    if not res:
-        print(res)
+    routing = get_routing(displayID)
+    if routing is None:
         print('failed to get it')
         return('failed to get piston addresses')
         
     # make sure we have the same numbers of piston positions and piston addresses
-    if len(shape) != len(res):
+    if len(shape) != routing.nPins:
         print('shape is different length than number of pistons')
         return('wrong shape for this display')
 
-    # third convert everything to numpy arrays of ints
-    PLCs = np.array(list(zip(*res))[0])       # grab 0th element from each tuple as PLC number
-    pins = np.array(list(zip(*res))[1])       # grab 1st element from each tuple as pin number
-    pos =  np.array(list(map(int, list(shape))))  # convert string of 0s and 1s to int list
-    PLC_IDs = np.unique(PLCs)
+    # third get the shape as a numpy array
+    if isinstance(shape, str):
+        shape = PackedShape.from_string(shape)
+    pos = shape.bits.astype(np.int8)
+    PLC_IDs = routing.PLC_IDs
 
-    # make sure we can connect to RS485 modem
-    client = connect_RS485()
-    if not client:
-        print('failed to connect to modem')
-        return('Failed to connect to RS485 modem, using simulation mode...')
-    
-    
-    # finally, work through list, one PLC at a time, and set pins
+    # group the PLCs by the converter they hang off, each bus gets its own worker
+    jobs = {}
     for PLC in PLC_IDs:
-        thesePins = pins[np.where(PLCs == PLC)]
-        thesePos = pos[np.where(PLCs == PLC)]
-        # if less than half the pistons are up, set all low and then individually step through
-        if sum(thesePos) <= (chansEach/2):
-            client.write_register(address=1, value=2048, unit=PLC) 
-            pinsToChange = thesePins[np.where(thesePos == 1)]
-            for pin in pinsToChange:
-                client.write_register(address=pin, value=256, unit=PLC)
-        
-        # if at least half the pistons are up, set all high and then individually step through
-        else: 
-            client.write_register(address=1, value=1792, unit=PLC) 
-            pinsToChange = thesePins[np.where(thesePos == 0)]
-            for pin in pinsToChange:
-                client.write_register(address=pin, value=512, unit=PLC)
-
-    client.close() # not clear that this does anything worthwhile
+        jobs.setdefault(get_bus(PLC), []).append(PLC)
+    deadline = time.monotonic() + shapeDeadline
+    
+    def drive_bus(bus, busPLCs):
+        # hold the bus for the whole shape so toggles from other threads can't land mid-redraw
+        with bus.lock:
+            # make sure we can connect to RS485 modem
+            if not bus.is_open():
+                print('failed to connect to modem')
+                return('Failed to connect to RS485 modem, using simulation mode...')
+            
+            # finally, work through list, one PLC at a time, and set pins
+            failed = []   # PLCs that timed out or refused writes, the shape still goes to the rest
+            for PLC in busPLCs:
+                if time.monotonic() > deadline:
+                    return '; '.join(failed + ['Redraw deadline passed before PLC ' + str(PLC)])
+                idx = routing.pistons_on(PLC)
+                thesePins = routing.chan[idx]
+                thesePos = pos[idx]
+                if force:
+                    forget_PLC_state(PLC)
+                writes = cached_plan(PLC, thesePins, thesePos, bulkWrites and PLC not in noBulkPLCs, PLC_state(PLC))
+                nErrors = write_PLC(PLC, writes)
+                if nErrors is None:
+                    return '; '.join(failed + ['Lost connection to RS485 modem'])
+                if nErrors:
+                    failed.append(PLC_failure(PLC, nErrors))
+        return '; '.join(failed) if failed else '1'
+    
+    t0 = time.perf_counter()
+    if len(jobs) == 1:
+        results = [drive_bus(*next(iter(jobs.items())))]
+    else:
+        results = list(busPool.map(lambda job: drive_bus(*job), jobs.items()))
+    lastRedraw.update(displayID=displayID, seconds=time.perf_counter() - t0, PLCs=len(PLC_IDs), buses=len(jobs))
+    metrics.observe('redraw_seconds', lastRedraw['seconds'], kind='shape')
     
-    return('1')    
+    errors = [r for r in results if r != '1']
+    return '; '.join(errors) if errors else '1'
+
+
+def PLC_failure(PLC, nErrors):
+    # how a PLC whose writes failed shows up in a redraw's result
+    return 'PLC ' + str(PLC) + ': ' + str(nErrors) + ' write' + ('s' if nErrors > 1 else '') + ' failed'
+
+
+def frame_cost(writes, baud=19200):
+    ## modeled bus time (s) for a list of (address, value) writes, value is a list for function 16
+    #  RTU frames: single write is 8 bytes out and 8 back, function 16 is 9+2n out and 8 back
+    nBytes = sum(17 + 2*len(val) if isinstance(val, list) else 16 for address, val in writes)
+    return len(writes) * frameGap + nBytes * 10. / baud
+
+
+def channel_runs(pins, vals):
+    # group per-channel values into runs of consecutive registers, one function 16 write per run
+    order = np.argsort(pins)
+    pins, vals = pins[order], vals[order]
+    breaks = np.where(np.diff(pins) != 1)[0] + 1
+    return [(int(p[0]), v.tolist()) for p, v in zip(np.split(pins, breaks), np.split(vals, breaks))]
+
+
+def PLC_state(PLC):
+    # (up, known) channel arrays for this PLC, everything unknown until we've written it
+    PLC = int(PLC)
+    if PLC not in plcState:
+        plcState[PLC] = (np.zeros(chansEach+1, dtype=bool), np.zeros(chansEach+1, dtype=bool))
+    return plcState[PLC]
+
+def forget_PLC_state(PLC=None):
+    # mark one PLC (or all of them) as unknown so the next shape is written in full
+    for key in ([int(PLC)] if PLC is not None else list(plcState)):
+        PLC_state(key)[1][:] = False
+
+def note_write(PLC, address, val, ok):
+    # keep plcState in step with a write we just sent
+    up, known = PLC_state(PLC)
+    if not ok:
+        known[:] = False   # no idea what the PLC did, redraw it in full next time
+    else:
+        apply_write(up, known, address, val)
+
+def apply_write(up, known, address, val):
+    # update (up, known) channel arrays for a write the PLC accepted
+    if isinstance(val, list):
+        up[address:address+len(val)] = np.array(val) == 256
+        known[address:address+len(val)] = True
+    elif address == 1 and val in (1792, 2048):
+        up[1:] = val == 1792
+        known[1:] = True
+    elif val in (256, 512):
+        up[address] = val == 256
+        known[address] = True
+
+
+def plan_PLC(pins, pos, bulk=True, state=None):
+    ## work out the register writes that put one PLC's pistons into pos (1 up, 0 down)
+    #  reset-plus-exceptions: all low or all high at address 1, then flip the minority one at a time
+    #  bulk: write 256/512 straight into the channel registers with function 16
+    #  diff: given the PLC's (up, known) state, only the channels that actually change
+    #  returns a list of (address, value) with value a list for bulk writes, whichever is cheapest
+    
+    # if less than half the pistons are up, set all low and then individually step through
+    if sum(pos) <= (chansEach/2):
+        options = [[(1, 2048)] + [(int(pin), 256) for pin in pins[np.where(pos == 1)]]]
+    # if at least half the pistons are up, set all high and then individually step through
+    else:
+        options = [[(1, 1792)] + [(int(pin), 512) for pin in pins[np.where(pos == 0)]]]
+    
+    if bulk:
+        options.append(channel_runs(pins, np.where(pos == 1, 256, 512)))
+    
+    if state is not None:
+        up, known = state
+        target = pos.astype(bool)
+        changed = ~known[pins] | (up[pins] ^ target)
+        diffPins, diffVals = pins[changed], np.where(target[changed], 256, 512)
+        options.append([(int(pin), int(val)) for pin, val in zip(diffPins, diffVals)])
+        if bulk and len(diffPins):
+            options.append(channel_runs(diffPins, diffVals))
+    
+    return min(options, key=frame_cost)
+
+
+planCache = collections.OrderedDict()  # (PLC, bulk, pins, target, up, known) -> writes, in LRU order
+planLock = threading.Lock()
+planStats = dict(hits=0, misses=0, prefetched=0)
+planPool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='planner')  # background prefetch_plans
+
+def cached_plan(PLC, pins, pos, bulk, state, prefetch=False):
+    ## plan_PLC through an LRU cache
+    #  the key is everything the plan depends on, so entries never go stale: the same PLC state
+    #  and target always give the same writes. A full redraw is just the all-unknown state
+    up, known = state
+    key = (int(PLC), bool(bulk), pins.tobytes(), pos.tobytes(), up.tobytes(), known.tobytes())
+    with planLock:
+        writes = planCache.get(key)
+        if writes is not None:
+            planCache.move_to_end(key)
+            if not prefetch:
+                planStats['hits'] += 1
+            return writes
+    
+    writes = plan_PLC(pins, pos, bulk, state)
+    with planLock:
+        planCache[key] = writes
+        while len(planCache) > planCacheSize:
+            planCache.popitem(last=False)
+        planStats['prefetched' if prefetch else 'misses'] += 1
+    return writes
+
+def prefetch_plans(displayID, shapes, chain=True, full=False):
+    ## plan shapes ahead of time so drawing them is a cache hit and only the serial writes are left
+    #  shapes are PackedShapes, None for a blank. chain plans each one from the state the one before
+    #  leaves the PLCs in, as for a sequence, otherwise each is planned from the PLCs' current state
+    routing = get_routing(displayID)
+    if routing is None:
+        return
+    current = {int(PLC): PLC_state(PLC) for PLC in routing.PLC_IDs}
+    states = {PLC: (up.copy(), known.copy()) for PLC, (up, known) in current.items()}
+    for shape in shapes:
+        if not chain:
+            states = {PLC: (up.copy(), known.copy()) for PLC, (up, known) in current.items()}
+        if shape is None:
+            for up, known in states.values():
+                apply_write(up, known, 1, 2048)
+            continue
+        if len(shape) != routing.nPins:
+            continue
+        pos = shape.bits.astype(np.int8)
+        for PLC, (up, known) in states.items():
+            if full:
+                known[:] = False
+            idx = routing.pistons_on(PLC)
+            writes = cached_plan(PLC, routing.chan[idx], pos[idx], bulkWrites and PLC not in noBulkPLCs, (up, known), prefetch=True)
+            for address, val in writes:
+                apply_write(up, known, address, val)
+
+def prefetch_next_shapes(shapeID):
+    # plan the shapes after shapeID in its display's list, from where the PLCs are now
+    displayID = load_shape(shapeID)[1]
+    IDs = sorted([row[0] for row in get_shape_IDs(displayID)])
+    nextIDs = [ID for ID in IDs if ID > int(shapeID)][:prefetchAhead]
+    shapes = [load_shape(ID) for ID in nextIDs]
+    prefetch_plans(displayID, [shape[0] for shape in shapes if shape is not None], chain=False)
+
+
+def write_PLC(PLC, writes):
+    ## send one PLC's planned writes and track what the PLC should now be doing
+    #  returns the number of writes the PLC answered with an error, or None if the bus went away
+    #  a function 16 write the PLC refuses is redone one register at a time. Only illegal function
+    #  (exception code 1) means the firmware has no function 16, and the PLC is remembered so later
+    #  shapes go straight to single writes; other codes (busy, bad value) may pass, so just this write falls back
+    #  a write that gets no answer at all (a timeout) ends the PLC's writes there: anything more
+    #  would only wait out more timeouts with the bus held. The PLC is left unknown, to redraw in full
+    PLC = int(PLC)
+    nErrors = 0
+    bus = get_bus(PLC)
+    with bus.lock:
+        for address, val in writes:
+            if isinstance(val, list):
+                result = bus.write_registers(address, val, PLC)
+                if result is None:
+                    note_write(PLC, address, val, False)
+                    return None
+                if not result.isError():
+                    note_write(PLC, address, val, True)
+                    continue
+                if not hasattr(result, 'exception_code'):   # no answer, don't try it another way
+                    note_write(PLC, address, val, False)
+                    return nErrors + 1
+                if result.exception_code == 1:
+                    print('PLC ' + str(PLC) + ' rejected bulk write, falling back to single writes')
+                    noBulkPLCs.add(PLC)
+                singles = [(address + i, v) for i, v in enumerate(val)]
+                metrics.count('modbus_retries', len(singles), plc=PLC)
+            else:
+                singles = [(address, val)]
+            
+            for address, val in singles:
+                result = bus.write_register(address, val, PLC)
+                note_write(PLC, address, val, result is not None and not result.isError())
+                if result is None:
+                    return None
+                if result.isError():
+                    nErrors += 1
+                    if not hasattr(result, 'exception_code'):
+                        return nErrors
+    return nErrors
+
+
+# schema changes, applied in order at startup. PRAGMA user_version holds how many have been applied
+migrations = [
+    ["CREATE INDEX IF NOT EXISTS pistonAddressesByDisplay ON pistonAddressesTable(DisplayID, piston)",
+     "CREATE INDEX IF NOT EXISTS shapesByDisplay ON shapeTable(DisplayID)"],
+]
+
+def migrate_DB(con=None):
+    ## bring the disk db (or con) up to the current schema, run before the in-memory copy is made
+    own = con is None
+    if own:
+        con = sqlite3.connect(dbFile)
+    try:
+        version = con.execute("PRAGMA user_version").fetchall()[0][0]
+        for i in range(version, len(migrations)):
+            with con:
+                for cmd in migrations[i]:
+                    con.execute(cmd)
+                con.execute(f"PRAGMA user_version = {i+1}")
+            print('migrated db to schema version ' + str(i+1))
+    finally:
+        if own:
+            con.close()
 
 
 def local_copy_DB():
+    ## make a fresh in-memory copy of the disk db and swap it in
+    #  only needed at startup or if the replica falls out of step, normal writes go through db_write
     global dest
-    print(dest)
     
-    if chk_conn_db(dest):
-        dest.close()
-        dest = []
-
+    t0 = time.perf_counter()
     source = sqlite3.connect(dbFile)
-    dest = sqlite3.connect(':memory:', check_same_thread=False)
-    source.backup(dest)
+    replica = sqlite3.connect(':memory:', check_same_thread=False)
+    source.backup(replica)
     source.close()
+    metrics.observe('db_copy_seconds', time.perf_counter() - t0)
+    
+    with destLock:
+        old, dest = dest, replica
+        if chk_conn_db(old):
+            old.close()
     print(dest)
-    # return dest
 
-def backup_DB():
-    import shutil
-    dst = os.path.dirname(dbFile) + '/db_backup/'   # Destination path
-    file_name, file_ext = os.path.splitext(os.path.basename(dbFile))  # Split the file name and extension
-    new_file_name = file_name + "_copy"  # Create a variable to hold the new file name
-    
-    # Increment the file name until we find a free filename
-    i = 1
-    while os.path.exists(os.path.join(dst, new_file_name + file_ext)):
-        new_file_name = "{}_copy_{}".format(file_name, i)
-        i += 1
+
+def query(cmd, params=()):
+    # read from the in-memory replica, holding it still for the length of the query
+    with metrics.timer('db_query_seconds'), destLock:
+        return dest.execute(cmd, params).fetchall()
+
+
+def db_write(statements):
+    ## write-through: apply the same statements to the disk file and then the in-memory replica,
+    #  each in a single transaction. statements is a list of (sql, params) tuples, where params
+    #  given as a list of rows goes through executemany
+    #  readers see the replica from before or after the whole change, never part of it
+    #  callers that work out new IDs from the replica should hold dbLock around that and this
+    def apply(con):
+        with con:   # commits, or rolls back if anything raises
+            for cmd, params in statements:
+                if isinstance(params, list):
+                    con.executemany(cmd, params)
+                else:
+                    con.execute(cmd, params)
+    
+    with dbLock, metrics.timer('db_write_seconds'):
+        con = sqlite3.connect(dbFile)
+        try:
+            apply(con)
+        finally:
+            con.close()
+        
+        with destLock:
+            try:
+                apply(dest)
+            except sqlite3.Error as ex:
+                print('in-memory db out of step with disk (' + str(ex) + '), recopying')
+                local_copy_DB()
+
+
+displayCols = ('nPins', 'nPLCs', 'rMin', 'rAU', 'rMax', 'pistonR', 'pistonPitch', 'vacPLC', 'vacChan')
+pistonCols = ('piston', 'PLC_ID', 'PLC_Chan', 'q', 'r', 's', 'x', 'y', 'AlwaysUp')
+exportChunk = 500  # rows per line of an export, and per query while writing one
+
+def export_display(displayID):
+    ## a display and its shapes as lines of NDJSON, read a chunk at a time so memory use doesn't
+    #  grow with the library and the replica is never held for longer than one chunk
+    #    {"type": "display", "version": 1, "props": {...}}        displayPropsTable, less the DisplayID
+    #    {"type": "pistons", "columns": [...], "rows": [...]}     pistonAddressesTable, less the DisplayID
+    #    {"type": "shapes", "nBits": n, "shapes": [[shapeID, shapeB64], ...]}   bits as in format=packed
+    #    {"type": "end", "pistons": n, "shapes": n}
+    #  raises ValueError before yielding anything if there's no such display
+    displayID = int(displayID)
+    props = query("SELECT " + ', '.join(displayCols) + " FROM displayPropsTable WHERE DisplayID=?", (displayID,))
+    if not props:
+        raise ValueError('no display ' + str(displayID))
+    
+    def lines():
+        yield json.dumps(dict(type='display', version=1, sourceDisplayID=displayID, props=dict(zip(displayCols, props[0])))) + '\n'
+        
+        nPistons, last = 0, None
+        while True:
+            rows = query("SELECT " + ', '.join(pistonCols) + " FROM pistonAddressesTable WHERE DisplayID=? AND piston>? ORDER BY piston LIMIT ?",
+                         (displayID, -2**63 if last is None else last, exportChunk))
+            if not rows:
+                break
+            nPistons, last = nPistons + len(rows), rows[-1][0]
+            yield json.dumps(dict(type='pistons', columns=pistonCols, rows=rows)) + '\n'
+        
+        nShapes, last = 0, 0
+        while True:
+            rows = query("SELECT shapeID, shapeBits, shapeFull FROM shapeTable WHERE DisplayID=? AND shapeID>? ORDER BY shapeID LIMIT ?",
+                         (displayID, last, exportChunk))
+            if not rows:
+                break
+            nShapes, last = nShapes + len(rows), rows[-1][0]
+            yield json.dumps(dict(type='shapes', nBits=rows[0][1],
+                                  shapes=[[ID, PackedShape(nBits, blob).to_b64()] for ID, nBits, blob in rows])) + '\n'
+        
+        yield json.dumps(dict(type='end', pistons=nPistons, shapes=nShapes)) + '\n'
+    return lines()
+
+
+def import_display(lines):
+    ## read an export_display stream (any iterable of lines) into a new display, in one transaction
+    #  the display and its shapes get new IDs, shapes keep their order: the n-th one in the stream
+    #  becomes firstShapeID + n. Anything wrong with the stream raises ValueError and nothing is stored
+    #  rows go to disk as they're read, then the new display is copied into the replica in one go
+    #  dbLock is held while lines are read, so lines should come from something already received (a file)
+    with dbLock:   # nobody else can take our IDs until they're written
+        newDisplayID = (query("SELECT MAX(DisplayID) FROM displayPropsTable")[0][0] or 0) + 1
+        seq = query("SELECT seq FROM sqlite_sequence WHERE name = 'shapeTable'")
+        maxID = query("SELECT MAX(shapeID) FROM shapeTable")[0][0]
+        firstShapeID = nextShapeID = max(seq[0][0] if seq else 0, maxID or 0) + 1
+        nPins, nPistons, ended = None, 0, False
+        
+        con = sqlite3.connect(dbFile)
+        try:
+            with con:   # commits at the end, or rolls back if anything raises
+                for line in lines:
+                    line = line.decode() if isinstance(line, bytes) else line
+                    if not line.strip():
+                        continue
+                    try:
+                        item = json.loads(line)
+                        kind = item['type']
+                        if nPins is None and kind != 'display':
+                            raise ValueError('stream has to start with the display')
+                        
+                        if kind == 'display':
+                            if nPins is not None:
+                                raise ValueError('more than one display in the stream')
+                            if item.get('version') != 1:
+                                raise ValueError('unknown export version ' + str(item.get('version')))
+                            props = tuple([item['props'][col] for col in displayCols])
+                            nPins = int(props[0])
+                            con.execute("INSERT INTO displayPropsTable VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (newDisplayID,) + props)
+                        
+                        elif kind == 'pistons':
+                            cols = [item['columns'].index(col) for col in pistonCols]
+                            con.executemany("INSERT INTO pistonAddressesTable(DisplayID, " + ', '.join(pistonCols) + ") VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                            [(newDisplayID,) + tuple([row[i] for i in cols]) for row in item['rows']])
+                            nPistons += len(item['rows'])
+                        
+                        elif kind == 'shapes':
+                            nBits = int(item['nBits'])
+                            if nBits != nPins:
+                                raise ValueError('shapes have ' + str(nBits) + ' pistons, the display has ' + str(nPins))
+                            con.executemany("INSERT INTO shapeTable(shapeID, DisplayID, shapeBits, shapeFull) VALUES(?, ?, ?, ?)",
+                                            [(nextShapeID + i, newDisplayID, nBits, PackedShape.from_b64(nBits, b64).blob)
+                                             for i, (oldID, b64) in enumerate(item['shapes'])])
+                            nextShapeID += len(item['shapes'])
+                        
+                        elif kind == 'end':
+                            if item.get('pistons') != nPistons or item.get('shapes') != nextShapeID - firstShapeID:
+                                raise ValueError('stream is missing rows')
+                            ended = True
+                    except (KeyError, TypeError, IndexError, binascii.Error) as ex:
+                        raise ValueError('bad line in stream: ' + repr(ex))
+                
+                if not ended:
+                    raise ValueError('stream ended early')
+                if nPistons != nPins:
+                    raise ValueError('display has ' + str(nPins) + ' pistons but the stream had ' + str(nPistons))
+        finally:
+            con.close()
+        
+        copy_display_to_replica(newDisplayID)
     
-    shutil.copy(dbFile, os.path.join(dst, new_file_name + file_ext))  # Copy the file to the new location with the new file name
+    forget_display_caches(newDisplayID)
+    print('Imported display ' + str(newDisplayID) + ' with ' + str(nextShapeID - firstShapeID) + ' shapes')
+    return dict(displayID=newDisplayID, nPins=nPins, shapes=nextShapeID - firstShapeID, firstShapeID=firstShapeID)
+
+
+def copy_display_to_replica(displayID):
+    # pull one display's rows from the disk db into the in-memory replica, inside sqlite
+    with destLock:
+        try:
+            dest.execute("ATTACH DATABASE ? AS disk", (dbFile,))
+            try:
+                with dest:
+                    for table in ('displayPropsTable', 'pistonAddressesTable', 'shapeTable'):
+                        dest.execute("INSERT INTO main." + table + " SELECT * FROM disk." + table + " WHERE DisplayID=?", (int(displayID),))
+            finally:
+                dest.execute("DETACH DATABASE disk")
+        except sqlite3.Error as ex:
+            print('in-memory db out of step with disk (' + str(ex) + '), recopying')
+            local_copy_DB()
+
+
+class Snapshots:
+    ## timestamped copies of the disk db in backupDir, made with sqlite's online backup API
+    #  the copy goes backupPages at a time with a pause in between, so writers only ever wait for one step
+    #  and reads (which go to the replica) not at all. One snapshot runs at a time, on its own thread,
+    #  which also takes one every backupEvery seconds if that's set. Snapshots are written under a
+    #  temporary name and renamed when done, so a listed snapshot is always a whole one
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self.cond = threading.Condition()
+        self.thread = None
+        self.wanted = []     # labels of snapshots asked for and not yet started
+        self.running = None  # progress of the snapshot being taken
+        self.last = None     # how the last one went
+        self.done = 0        # snapshots finished, so take() can wait for its own
+        self.pinned = set()  # snapshots being restored, prune leaves them alone
+    
+    def name(self, label=''):
+        # Grasp3Shapes_20240131-235959_123456[_label].db, sorted by name is sorted by time
+        base = os.path.splitext(os.path.basename(dbFile))[0]
+        label = re.sub(r'[^A-Za-z0-9-]', '', label or '')
+        stamp = time.strftime('%Y%m%d-%H%M%S') + '_%06d' % (time.time() % 1 * 1e6)
+        return base + '_' + stamp + ('_' + label if label else '') + '.db'
+    
+    def pattern(self):
+        return re.compile(re.escape(os.path.splitext(os.path.basename(dbFile))[0]) + r'_(\d{8}-\d{6})_\d{6}(?:_[A-Za-z0-9-]+)?\.db$')
+    
+    def list(self):
+        # [{name, time, bytes}], newest first. older _copy_N backups aren't ours and are left alone
+        snaps = []
+        pattern = self.pattern()
+        for name in os.listdir(self.folder) if os.path.isdir(self.folder) else []:
+            m = pattern.match(name)
+            if m:
+                snaps.append(dict(name=name, time=time.mktime(time.strptime(m.group(1), '%Y%m%d-%H%M%S')),
+                                  bytes=os.path.getsize(os.path.join(self.folder, name))))
+        return sorted(snaps, key=lambda snap: snap['name'], reverse=True)
+    
+    def start(self, label=''):
+        # queue a snapshot for the background thread and return straight away
+        with self.cond:
+            self.wanted.append(label)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='snapshots', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+            return self.done + len(self.wanted) + (self.running is not None)
+    
+    def take(self, label=''):
+        # snapshot now and wait for it, returns the status it finished with
+        ticket = self.start(label)
+        with self.cond:
+            self.cond.wait_for(lambda: self.done >= ticket)
+            return dict(self.last)
+    
+    def status(self):
+        with self.cond:
+            return dict(running=dict(self.running) if self.running else None, queued=len(self.wanted),
+                        last=dict(self.last) if self.last else None, every=backupEvery, keep=backupKeep, days=backupDays)
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.wanted:
+                    self.cond.wait(backupEvery if backupEvery > 0 else None)
+                label = self.wanted.pop(0) if self.wanted else 'auto'   # woken by the timeout
+                self.running = dict(name=self.name(label), pages=0, remaining=None, started=time.time())
+            try:
+                result = self._snapshot(self.running)
+            except (sqlite3.Error, OSError) as ex:
+                print('snapshot failed: ' + str(ex))
+                result = dict(self.running, error=str(ex))
+            with self.cond:
+                self.running, self.last = None, result
+                self.done += 1
+                self.cond.notify_all()
+    
+    def _snapshot(self, progress):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, progress['name'])
+        
+        def step(status, remaining, total):
+            with self.cond:
+                progress.update(pages=total - remaining, remaining=remaining)
+            if remaining:
+                time.sleep(0.001)   # let any waiting writer in between steps
+        
+        with metrics.timer('snapshot_seconds'):
+            source = sqlite3.connect(dbFile)
+            target = sqlite3.connect(path + '.part')
+            try:
+                source.backup(target, pages=backupPages, progress=step)
+                target.execute("PRAGMA journal_mode=DELETE")   # the db is WAL, a snapshot should be one self contained file
+            finally:
+                target.close()
+                source.close()
+            os.replace(path + '.part', path)
+        
+        pruned = self.prune()
+        print('Snapshot ' + progress['name'] + (', pruned ' + str(len(pruned)) if pruned else ''))
+        return dict(progress, seconds=time.time() - progress['started'], bytes=os.path.getsize(path), pruned=pruned)
+    
+    def prune(self):
+        ## delete snapshots the retention policy doesn't need: it keeps the newest backupKeep, and
+        #  of the rest, the newest of each day for backupDays days
+        snaps = self.list()
+        days, pruned = set(), []
+        for i, snap in enumerate(snaps):
+            day = time.strftime('%Y%m%d', time.localtime(snap['time']))
+            recent = time.time() - snap['time'] < backupDays * 86400
+            if i >= backupKeep and not (recent and day not in days) and snap['name'] not in self.pinned:
+                os.remove(os.path.join(self.folder, snap['name']))
+                pruned.append(snap['name'])
+            days.add(day)
+        return pruned
+    
+    def restore(self, name):
+        ## put a snapshot back: it's loaded into a new in-memory replica (checked and migrated there),
+        #  written over the disk db with the backup API, then swapped in for readers
+        #  writers wait throughout and the current db is snapshotted first, so a restore can be undone
+        #  the snapshot is loaded before that, and pinned, so the undo snapshot can't prune it away
+        #  raises ValueError for a name that isn't one of ours or a snapshot that can't be read or fails its check
+        if name not in [snap['name'] for snap in self.list()]:
+            raise ValueError('no snapshot ' + str(name))
+        
+        global dest
+        with dbLock, metrics.timer('restore_seconds'):
+            with self.cond:
+                self.pinned.add(name)
+            try:
+                replica = self.load(name)
+                try:
+                    undo = self.take('prerestore')
+                    if 'error' in undo:
+                        raise ValueError('could not snapshot the current db first: ' + undo['error'])
+                    disk = sqlite3.connect(dbFile)
+                    try:
+                        replica.backup(disk)
+                    finally:
+                        disk.close()
+                except (sqlite3.Error, ValueError) as ex:
+                    replica.close()
+                    raise ValueError('restoring ' + name + ' failed: ' + str(ex))
+            finally:
+                with self.cond:
+                    self.pinned.discard(name)
+            
+            with destLock:
+                old, dest = dest, replica
+                if chk_conn_db(old):
+                    old.close()
+            forget_display_caches()
+        print('Restored ' + name)
+        return dict(restored=name, undo=undo['name'])
+    
+    def load(self, name):
+        # a snapshot copied into a new in-memory db, checked and migrated. mode=ro, so a snapshot that's
+        # gone missing raises rather than being created empty
+        replica = sqlite3.connect(':memory:', check_same_thread=False)
+        try:
+            source = sqlite3.connect('file:' + os.path.join(self.folder, name) + '?mode=ro', uri=True)
+            try:
+                source.backup(replica)
+            finally:
+                source.close()
+            check = replica.execute("PRAGMA quick_check").fetchall()
+            if check != [('ok',)]:
+                raise ValueError('snapshot ' + name + ' failed its check: ' + str(check[:3]))
+            tables = set([row[0] for row in replica.execute("SELECT name FROM sqlite_master WHERE type='table'")])
+            missing = set(['shapeTable', 'pistonAddressesTable', 'displayPropsTable']) - tables
+            if missing:
+                raise ValueError('snapshot ' + name + ' has no ' + ', '.join(sorted(missing)))
+            migrate_DB(replica)
+        except (sqlite3.Error, ValueError) as ex:
+            replica.close()
+            raise ValueError(str(ex))
+        return replica
+
+snapshots = Snapshots(backupDir)
+if backupEvery > 0:
+    snapshots.start('auto')
+
+
+def backup_DB(label='backup'):
+    # snapshot the db now, see Snapshots
+    return snapshots.take(label)
 
 
 def create_hex_array(rMin=5, rAlwaysUp=7, rMax=25, pistonR = 1.1, pistonPitch=3.4):
     ## creates qrs coordinates for hex array that are within rMax (mm) and outside rMin (mm)
     #  and then saves it to the database
     #  pistons closer than alwaysUp (mm) are labeled as such in the DB
+    #  raises ValueError for settings layout_hex_array won't take, or that give no pistons at all
+    rows, props = layout_hex_array(rMin, rAlwaysUp, rMax, pistonR, pistonPitch)
+    if not rows:
+        raise ValueError('no pistons fit between rMin and rMax (or rAlwaysUp) with these settings')
+
+    with dbLock:   # nobody else can take our new display ID until it's written
+        # figure out what id to use for the new display
+        try:
+            res = query("Select MAX(DisplayID) from displayPropsTable")
+            newDisplayID = res[0][0] + 1
+        except:
+            newDisplayID = 1
+        print(newDisplayID)
+        
+        # write the display to disk and the in-memory db together
+        db_write([("INSERT INTO pistonAddressesTable VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [(newDisplayID,) + row for row in rows]),
+                  ("INSERT INTO displayPropsTable VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (newDisplayID,) + props)])
     
+    forget_display_caches(newDisplayID)
+    print('Stored ' + str(props[0]) + ' pistons as array ' + str(newDisplayID))
+    
+    return newDisplayID
+
 
-    global dest # we need to update the in-memory db connection after this
-    global chansEach
+def layout_hex_array(rMin=5, rAlwaysUp=7, rMax=25, pistonR = 1.1, pistonPitch=3.4):
+    ## work out a display without storing it: pistonAddressesTable rows (less the DisplayID) and
+    #  displayPropsTable values (less the DisplayID), as create_hex_array would write them
+    #  pistons are numbered ring by ring from the middle, in get_QRS order, and fill each PLC's channels in turn
+    #  raises ValueError for settings that don't make a display, or one bigger than maxHexRings
+    if not all([math.isfinite(v) for v in (rMin, rAlwaysUp, rMax, pistonR, pistonPitch)]):
+        raise ValueError('display settings must be numbers')
+    if pistonPitch <= 0:
+        raise ValueError('pistonPitch must be more than 0')
     mult = pistonPitch / 1.1547  # with pistons spaced every 1 unit on qrs grid, that's 1.15 on cartesian
     sin60 = np.sin(np.radians(60)) # used for figuring out the y position of each piston
     
-    con = sqlite3.connect(dbFile)
-    cur = con.cursor()
+    # every ring that could hold a piston (always up ones go out to rAlwaysUp, the rest to rMax):
+    # ring k is no closer than k * sin60 grid units to the middle
+    nRings = int(np.ceil(max(rMax, rAlwaysUp, 0) / (mult * sin60))) + 2
+    if nRings > maxHexRings:
+        raise ValueError('display too big, at most ' + str(int((maxHexRings - 2) * mult * sin60)) + ' mm across at this pitch')
+    QRS, ring = hex_lattice(nRings)
+    xs = QRS[:,0] * mult
+    ys = 2. * sin60 * (QRS[:,1] - QRS[:,2]) / 3. * mult
+    dists = np.sqrt(xs**2 + ys**2)
+    
+    alwaysUps = np.logical_and(dists >= rMin, dists <= rAlwaysUp)
+    sometimesUps = np.logical_and(dists > rAlwaysUp, dists < rMax)
+    used = alwaysUps | sometimesUps
+    
+    # the display is the rings from the first one with pistons up to (not including) the next one without any
+    ringUsed = np.bincount(ring[used], minlength=nRings) > 0
+    if ringUsed.any():
+        first = np.argmax(ringUsed)
+        gaps = np.flatnonzero(~ringUsed[first:])
+        used &= ring < (first + gaps[0] if len(gaps) else nRings)
+    
+    idx = np.flatnonzero(used)
+    nPins = len(idx)
+    slot = np.arange(nPins)
+    rows = list(zip((slot + 1).tolist(), (slot // chansEach + 1).tolist(), (slot % chansEach + 1).tolist(),
+                    QRS[idx,0].tolist(), QRS[idx,1].tolist(), QRS[idx,2].tolist(),
+                    np.round(xs[idx], 3).tolist(), np.round(ys[idx], 3).tolist(), alwaysUps[idx].astype(int).tolist()))
+
+    # the next free slot, as plc/chan
+    plc = nPins // chansEach + 1
+    chan = nPins % chansEach + 1
     
-    # figure out what id to use for the new display
-    try:
-        res = cur.execute("Select MAX(DisplayID) from displayPropsTable").fetchall()
-        newDisplayID = res[0][0] + 1
-    except:
-        newDisplayID = 1
-    print(newDisplayID)
-    
-    # find all piston positions that meet criteria and put in disk database
-    # addys = np.array([], dtype=np.short).reshape(0,3); # init the array that will hold QRSs
-    piston = 0  # piston ID incrementer
-    plc = 1     # PLC ID incrementer
-    chan = 1    # PLC Chan incrementer
-    zone = 0    # 0: inside Min, 1: maybe usable, 2: outside Max
-    qrsRad = 0  # step from inside to outside, construct this ring, check where we are
-    
-    
-    while not zone == 2:
-        QRS = get_QRS(qrsRad);           # QRS values of everything in this ring
-        xs = QRS[:,0] * mult;
-        ys = 2. * sin60 * (QRS[:,1] - QRS[:,2]) / 3. * mult; 
-        dists = np.sqrt(xs**2 + ys**2);
-        
-        alwaysUps = np.logical_and(dists >= rMin, dists <= rAlwaysUp)
-        sometimesUps = np.logical_and(dists > rAlwaysUp, dists < rMax)
-        
-        if zone == 0 and (alwaysUps.any() or sometimesUps.any()):
-            zone = 1
-        elif zone == 1 and not alwaysUps.any() and not sometimesUps.any():
-            zone = 2
-            break
-        
-        
-        # Step through each pin address
-        for i in range(np.size(QRS,0)):
-            alwaysUp = 1 if alwaysUps[i] else 0
-
-            if alwaysUps[i] or sometimesUps[i]:
-                piston += 1
-                cur.execute("INSERT INTO pistonAddressesTable VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [newDisplayID, piston, plc, chan, int(QRS[i,0]), int(QRS[i,1]), int(QRS[i,2]), round(xs[i], 3), round(ys[i], 3), alwaysUp])  
-
-                chan += 1
-                if chan > chansEach:
-                    chan = 1
-                    plc += 1
-                    
-        qrsRad += 1
-
     # make the vacuum channel the last channel on the current PLC unless it's already taken, in which case wrap around to next PLC
     vacChan = chansEach
     if chan == chansEach:
         plc += 1
 
-    cur.execute("INSERT INTO displayPropsTable VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [newDisplayID, piston, plc, rMin, rAlwaysUp, rMax, pistonR, pistonPitch, plc, vacChan])
-    con.commit()
-    con.close()   
-    
-    # update the in-memory db connection
-    local_copy_DB() 
-    
-    print('Stored ' + str(piston) + ' pistons as array ' + str(newDisplayID))
-    
-    return newDisplayID
+    return rows, (nPins, plc, rMin, rAlwaysUp, rMax, pistonR, pistonPitch, plc, vacChan)
     
 
-    
-        
+def preview_hex_array(rMin=5, rAlwaysUp=7, rMax=25, pistonR = 1.1, pistonPitch=3.4):
+    # what show_display would return for a display with these settings, without storing anything
+    rows, props = layout_hex_array(rMin, rAlwaysUp, rMax, pistonR, pistonPitch)
+    xys = [(row[0], row[6], row[7], row[8]) for row in rows]
+    return dict(xys=json.dumps(xys), nPins=props[0], nPLCs=props[1], rMin=rMin, rMax=rMax, pistonR=pistonR)
+
+
 def get_hex_array(displayID, style='qrs'):
     
     if style == 'qrs':
-        cmd = f"SELECT q, r, s FROM pistonAddressesTable WHERE DisplayID='{str(displayID)}'"
+        cmd = "SELECT q, r, s FROM pistonAddressesTable WHERE DisplayID=? ORDER BY piston"
     elif style=='xy':
-        cmd = f"SELECT piston, x, y, AlwaysUp FROM pistonAddressesTable WHERE DisplayID='{str(displayID)}'"
+        cmd = "SELECT piston, x, y, AlwaysUp FROM pistonAddressesTable WHERE DisplayID=? ORDER BY piston"
         
-    return dest.execute(cmd).fetchall()
+    return query(cmd, (int(displayID),))
 
 
 
 def get_display_IDs():
-    global dest
-    print(dest)
-    cmd = f"SELECT DisplayID FROM displayPropsTable"
-    return dest.execute(cmd).fetchall()
+    cmd = "SELECT DisplayID FROM displayPropsTable"
+    return query(cmd)
     
 
 
 def get_hex_array_props(displayID):
-    cmd = f"SELECT nPins, rMin, rMax, pistonR FROM displayPropsTable WHERE DisplayID='{str(displayID)}'"
-    return dest.execute(cmd).fetchall()
+    cmd = "SELECT nPins, rMin, rMax, pistonR FROM displayPropsTable WHERE DisplayID=?"
+    return query(cmd, (int(displayID),))
 
 
 def delete_hex_array(displayID = 100000):
-    global dest # we need to update the in-memory db connection after this
-    con = sqlite3.connect(dbFile)
-    con.cursor().execute(f"DELETE FROM pistonAddressesTable WHERE DisplayID={displayID}")
-    con.cursor().execute(f"DELETE FROM displayPropsTable WHERE DisplayID={displayID}")
-    con.cursor().execute(f"DELETE FROM shapeTable WHERE DisplayID={displayID}")
-    con.commit()
-    con.close()
-    
-    local_copy_DB() # update the in-memory db connection
+    displayID = int(displayID)
+    db_write([("DELETE FROM pistonAddressesTable WHERE DisplayID=?", (displayID,)),
+              ("DELETE FROM displayPropsTable WHERE DisplayID=?", (displayID,)),
+              ("DELETE FROM shapeTable WHERE DisplayID=?", (displayID,))])
+    forget_display_caches(displayID)
 
 
 
 def get_shape_IDs(displayID):
-    cmd = f"SELECT shapeID FROM shapeTable WHERE DisplayID={displayID}"
-    return dest.execute(cmd).fetchall()
+    cmd = "SELECT shapeID FROM shapeTable WHERE DisplayID=?"
+    return query(cmd, (int(displayID),))
 
 
 def get_shape(shapeID=2, col='shapeFull', plot=0):
-    ## Get the piston configuration from the database and return it as a binary string
+    ## Get the piston configuration from the database and return it as a PackedShape
     #  ensure that the shape is compatible with the chosen display
     global activePistons
-    cmd = f"SELECT shapeBits, {col} , DisplayID FROM shapeTable WHERE shapeID='{shapeID}'"
-    res = dest.execute(cmd).fetchall()
-    activePistons = bytes_to_binary_string(res[0][0], res[0][1])
-    displayID = res[0][2]
-    
-    if len(res):
-        return activePistons, displayID
-    else:
+    if col not in ('shapeFull',):   # column names can't be bound, so only allow the ones we know
+        raise ValueError('unknown shape column ' + str(col))
+    res = fetch_shape(shapeID, col)
+    if res is None:
         return '0'
+    activePistons, displayID = res
+    return activePistons, displayID
+
+shapeCache = collections.OrderedDict()  # shapeID -> (PackedShape, displayID), in LRU order
+shapeCacheLock = threading.Lock()
+
+def load_shape(shapeID):
+    # fetch_shape through an LRU cache, forget_display_caches drops a display's shapes
+    shapeID = int(shapeID)
+    with shapeCacheLock:
+        shape = shapeCache.get(shapeID)
+        if shape is not None:
+            shapeCache.move_to_end(shapeID)
+            return shape
+    shape = fetch_shape(shapeID)
+    if shape is not None:
+        with shapeCacheLock:
+            shapeCache[shapeID] = shape
+            while len(shapeCache) > shapeCacheSize:
+                shapeCache.popitem(last=False)
+    return shape
+
+def fetch_shape(shapeID, col='shapeFull'):
+    # (PackedShape, displayID) for a shape, or None if there's no such shape. Leaves activePistons alone
+    cmd = f"SELECT shapeBits, {col} , DisplayID FROM shapeTable WHERE shapeID=?"
+    res = query(cmd, (int(shapeID),))
+    if not len(res):
+        return None
+    return PackedShape(res[0][0], res[0][1]), res[0][2]
     
 def reset_DB():
-    global dest # we need to update the in-memory db connection after this
-    
-    backup_DB()      # copy file to new file in backup folder
+    backup_DB('reset')      # snapshot into the backup folder first
     
     # delete db entries
-    con = sqlite3.connect(dbFile)
-    con.cursor().execute(f"DELETE FROM pistonAddressesTable")
-    con.cursor().execute(f"DELETE FROM displayPropsTable")
-    con.cursor().execute(f"DELETE FROM shapeTable")
-    con.cursor().execute(f"UPDATE sqlite_sequence SET seq = 0 WHERE name = 'shapeTable'")
-    con.commit()
-    con.close()
-    
-    local_copy_DB() # update the in-memory db connection
+    db_write([("DELETE FROM pistonAddressesTable", ()),
+              ("DELETE FROM displayPropsTable", ()),
+              ("DELETE FROM shapeTable", ()),
+              ("UPDATE sqlite_sequence SET seq = 0 WHERE name = 'shapeTable'", ())])
+    forget_display_caches()
     
     
     
@@ -367,217 +1274,1227 @@ def get_QRS(rad):
     return np.transpose(np.array([qs, rs, (qs+rs) * -1]))
         
         
-def binary_string_to_bytes(binary):
-    bit_count = len(binary)
-    byte_count = math.ceil(bit_count / 8)
-    return int(binary, 2).to_bytes(byte_count, 'little')
-
-def bytes_to_binary_string(nBits, byteString):
-    integer = int.from_bytes(byteString, 'little')
-    return f'{integer:0{nBits}b}'
-
-
-    
+def hex_lattice(nRings):
+    ## QRS of every hex in rings 0..nRings-1 in one go, in the same order as stacking get_QRS(0), get_QRS(1), ...
+    #  also returns each hex's ring. Ring k has 6 sides of k hexes, each side a start corner plus t steps along it
+    k = np.repeat(np.arange(1, nRings), 6 * np.arange(1, nRings))
+    j = np.arange(len(k)) - np.repeat(3 * np.arange(nRings - 1) * np.arange(1, nRings), 6 * np.arange(1, nRings))
+    side, t = j // k, j % k
+    # q = qk * k + qt * t, r = rk * k + rt * t, one row per side
+    qk, qt = np.array([0, -1, -1, 0, 1, 1]), np.array([-1, 0, 1, 1, 0, -1])
+    rk, rt = np.array([1, 1, 0, -1, -1, 0]), np.array([0, -1, -1, 0, 1, 1])
+    qs = np.concatenate([[0], qk[side] * k + qt[side] * t])
+    rs = np.concatenate([[0], rk[side] * k + rt[side] * t])
+    return np.transpose(np.array([qs, rs, (qs+rs) * -1])), np.concatenate([[0], k])
+
+
+def bools_to_bytes(active):
+    # db layout: shape read as a binary number with the first piston as the most significant bit,
+    # stored as little-endian bytes
+    return np.packbits(np.asarray(active, dtype=bool)[::-1], bitorder='little').tobytes()
+
+
+class PackedShape:
+    ## one display state, kept as the db blob and unpacked to a bool array (bits[i] is piston i) on demand
+    #  wire format (to_b64) is base64 of np.packbits(bits): piston 0 is the top bit of the first byte
+    #  to_string gives the old '0'/'1' string for clients that still want it
+    
+    def __init__(self, nBits, blob):
+        self.nBits = int(nBits)
+        self.blob = bytes(blob)
+        self._bits = None
+        self._b64 = None
+        self._string = None
+    
+    @classmethod
+    def from_bools(cls, active):
+        shape = cls(len(active), bools_to_bytes(active))
+        shape._bits = np.array(active, dtype=bool)
+        return shape
+    
+    @classmethod
+    def from_string(cls, binary):
+        return cls.from_bools(np.frombuffer(binary.encode(), dtype=np.uint8) == ord('1'))
+    
+    @classmethod
+    def from_b64(cls, nBits, b64):
+        return cls.from_bools(np.unpackbits(np.frombuffer(base64.b64decode(b64), dtype=np.uint8), count=int(nBits)).astype(bool))
+    
+    @classmethod
+    def zeros(cls, nBits):
+        return cls.from_bools(np.zeros(int(nBits), dtype=bool))
+    
+    @property
+    def bits(self):
+        # read-only bool array, piston order
+        if self._bits is None:
+            raw = np.frombuffer(self.blob, dtype=np.uint8)   # a view on the blob, no copy
+            self._bits = np.unpackbits(raw, count=self.nBits, bitorder='little')[::-1].astype(bool)
+            self._bits.flags.writeable = False
+        return self._bits
+    
+    def __len__(self):
+        return self.nBits
+    
+    def with_piston(self, i, up):
+        # copy of this shape with piston index i set
+        bits = self.bits.copy()
+        bits[i] = bool(int(up))
+        return PackedShape.from_bools(bits)
+    
+    def to_b64(self):
+        if self._b64 is None:
+            self._b64 = base64.b64encode(np.packbits(self.bits).tobytes()).decode()
+        return self._b64
+    
+    def to_string(self):
+        if self._string is None:
+            self._string = np.where(self.bits, b'1', b'0').tobytes().decode()
+        return self._string
+
+
+def piston_neighbors(qrs):
+    ## adjacency table for a hex array: n x 6 array holding the index of each piston's neighbors, -1 if missing
+    #  neighbors are in the order [q+1, r-1], [q-1, r+1], [q-1, r], [q+1, r], [q, r+1], [q, r-1]
+    offsets = np.array([[1, -1], [-1, 1], [-1, 0], [1, 0], [0, 1], [0, -1]])
+    qr = np.asarray(qrs)[:, 0:2].astype(np.int64)
+    span = 2 * np.abs(qr).max() + 3 if len(qr) else 1   # big enough that q*span + r is unique
+    keys = qr[:, 0] * span + qr[:, 1]
+    order = np.argsort(keys)
+    nbKeys = (qr[:, None, 0] + offsets[:, 0]) * span + (qr[:, None, 1] + offsets[:, 1])
+    found = np.minimum(np.searchsorted(keys, nbKeys, sorter=order), len(keys) - 1)
+    nbs = order[found]
+    return np.where(keys[nbs] == nbKeys, nbs, -1)
+
+
+def shape_geometry(displayID):
+    ## everything create_shape needs to know about a display, built once per display
+    #  returns (neighbors, outward, alwaysUpIndices) where outward lists, for each piston, the neighbors
+    #  that are beside or further out than it (candidates for the next step of an arm)
+    displayID = int(displayID)
+    if displayID not in shapeGeometry:
+        qrs = np.array(query("SELECT q, r, s, AlwaysUp FROM pistonAddressesTable WHERE DisplayID=? ORDER BY piston", (displayID,)))
+        neighbors = piston_neighbors(qrs)
+        dist = np.abs(qrs[:, 0:3]).sum(1)
+        outwardMask = (neighbors >= 0) & (dist[np.maximum(neighbors, 0)] >= dist[:, None])
+        outward = [row[mask] for row, mask in zip(neighbors, outwardMask)]
+        shapeGeometry[displayID] = (neighbors, outward, np.where(qrs[:, 3])[0])
+    return shapeGeometry[displayID]
+
+
+def forget_display_caches(displayID=None):
+    # drop anything we've precomputed for a display (or all displays) after it changes in the db
+    for cache in (shapeGeometry, routingCache, shapeIndexes, geometryCache):
+        if displayID is None:
+            cache.clear()
+        else:
+            cache.pop(int(displayID), None)
+    with shapeCacheLock:
+        for shapeID, shape in list(shapeCache.items()):
+            if displayID is None or shape[1] == int(displayID):
+                del shapeCache[shapeID]
 
 
-def check_neighbor(target,q,r,s):
-    # checks to see if the specified piston is in the target array
-    return np.sum(np.logical_and(target[:,0]==q, target[:,1]==r, target[:,2]==s))
 
-def create_shape(displayID=1):
+def create_shape(displayID=1, minDistance=None):
     ## Select pistons to be high
     ##   and store in database as integer string
     ##   returns the shapeID of the new shape
+    #  with minDistance (default minShapeDistance) the shape is regenerated until it's at least
+    #  that many pistons away from every shape already on the display
+    minDistance = minShapeDistance if minDistance is None else int(minDistance)
+    
+    # get the properties for this display and build the shape
+    geometry = shape_geometry(displayID)
+    for attempt in range(100):
+        blob = PackedShape.from_bools(generate_shape(geometry)).blob
+        if not minDistance or shape_index(displayID).novel([blob], minDistance):
+            break
+    else:
+        print('no shape at least ' + str(minDistance) + ' pistons from the rest after 100 tries, keeping the last one')
     
-    # get the properties for this display
-    con = sqlite3.connect(dbFile)
-    qrs = con.cursor().execute(f"SELECT q, r, s, AlwaysUp FROM pistonAddressesTable WHERE DisplayID='{displayID}'").fetchall()
-    qrs = np.array(qrs)
-    alwaysUpIndices = np.where(qrs[:,3])[0].tolist()
-    
-    # build the shape
-    binary = '0'*len(qrs)
-    binary = fill_always_up(binary, alwaysUpIndices)
-    binary = add_arms(qrs, alwaysUpIndices, binary)
-    binary = fill_holes(qrs, binary)     
-    minNeighbor = 0 if len(binary) < 20 else 1  # this avoids situation where small displays get all fingers removed
-    binary = remove_fingers(qrs, binary, minNeighbor)
-    byteString = binary_string_to_bytes(binary)
-
     # put the new shape in the database
-    con.cursor().execute("INSERT INTO shapeTable(DisplayID, shapeBits, shapeFull) VALUES(?, ?, ?)", (displayID, len(binary), byteString))
-    newShapeID = con.cursor().execute("Select MAX(shapeID) from shapeTable").fetchall()[0][0]
-    con.commit()
-    con.close()
-    
+    newShapeID = insert_shapes(displayID, len(geometry[0]), [blob])[0]
     print('Added shape ' + str(newShapeID))    
     
-    # update the in-memory db connection
-    local_copy_DB() 
-    
     return newShapeID
 
-def fill_always_up(binary, alwaysUpIndices):
-    # Set all the middle pins high
+
+def create_shapes(displayID, n, seed=None, workers=1, minDistance=None):
+    ## generate n shapes for a display and store them in a single transaction
+    #  shapes are made in fixed-size chunks, each with its own child seed of `seed`, so the same seed
+    #  gives the same library however many worker processes share the chunks
+    #  shapes closer than minDistance (default minShapeDistance) to the library or to an earlier
+    #  shape in the batch are dropped rather than regenerated, so the seed still decides the result
+    #  returns (list of new shapeIDs, seed used)
+    minDistance = minShapeDistance if minDistance is None else int(minDistance)
+    if seed is None:
+        seed = random.randrange(2**31)
+    geometry = shape_geometry(displayID)
+    
+    chunk = 250
+    sizes = [min(chunk, n - i) for i in range(0, n, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    
+    if workers > 1 and len(sizes) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(generate_shapes, [geometry] * len(sizes), sizes, seeds))
+    else:
+        chunks = [generate_shapes(geometry, size, ss) for size, ss in zip(sizes, seeds)]
+    
+    shapes = [shape for c in chunks for shape in c]
+    if minDistance:
+        keep = shape_index(displayID).novel(shapes, minDistance)
+        if len(keep) < len(shapes):
+            print('Dropped ' + str(len(shapes) - len(keep)) + ' shapes closer than ' + str(minDistance) + ' pistons to another')
+        shapes = [shapes[i] for i in keep]
+    newShapeIDs = insert_shapes(displayID, len(geometry[0]), shapes)
+    print('Added ' + str(len(newShapeIDs)) + ' shapes to display ' + str(displayID))
+    
+    return newShapeIDs, seed
+
+
+def generate_shape(geometry, rng=np.random):
+    # one random shape as a bool array, geometry comes from shape_geometry
+    neighbors, outward, alwaysUpIndices = geometry
+    
+    active = np.zeros(len(neighbors), dtype=bool)
+    active[alwaysUpIndices] = True            # Set all the middle pins high
+    add_arms(outward, alwaysUpIndices, active, rng)
+    fill_holes(neighbors, active)     
+    minNeighbor = 0 if len(active) < 20 else 1  # this avoids situation where small displays get all fingers removed
+    remove_fingers(neighbors, active, minNeighbor)
+    return active
+
+
+def generate_shapes(geometry, n, seed):
+    # n shapes packed the way shapeTable stores them, kept at module level so worker processes can run it
+    rng = np.random.default_rng(seed)
+    return [PackedShape.from_bools(generate_shape(geometry, rng)).blob for i in range(n)]
+
+
+def insert_shapes(displayID, nBits, shapes):
+    ## store packed shapes for a display in one transaction on disk and in memory
+    #  returns the new shapeIDs in order
+    with dbLock:   # nobody else can take our IDs until they're written
+        seq = query("SELECT seq FROM sqlite_sequence WHERE name = 'shapeTable'")
+        maxID = query("SELECT MAX(shapeID) FROM shapeTable")[0][0]
+        first = max(seq[0][0] if seq else 0, maxID or 0) + 1
+        newShapeIDs = list(range(first, first + len(shapes)))
+        db_write([("INSERT INTO shapeTable(shapeID, DisplayID, shapeBits, shapeFull) VALUES(?, ?, ?, ?)",
+                   [(shapeID, displayID, nBits, shape) for shapeID, shape in zip(newShapeIDs, shapes)])])
+        
+        # keep the similarity index in step, if there is one yet
+        index = shapeIndexes.get(int(displayID))
+        if index is not None:
+            index.add(newShapeIDs, shapes)
     
-    for i in alwaysUpIndices:
-        binary = binary[:i] + '1' + binary[i+1:] 
-    return binary
+    return newShapeIDs
+
 
-def add_arms(qrs, fingerStarts, binary):
+popTable = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(words):
+    # set bits in each row of a uint64 array, summed over the last axis a word at a time
+    # (numpy is slow at summing a short last axis)
+    total = np.zeros(words.shape[:-1], dtype=np.int32)
+    for w in range(words.shape[-1]):
+        if hasattr(np, 'bitwise_count'):
+            total += np.bitwise_count(words[..., w])
+        else:
+            total += popTable[words[..., w:w+1].view(np.uint8)].sum(axis=-1, dtype=np.int32)
+    return total
+
+
+class ShapeIndex:
+    ## a display's shape library as a matrix of packed shapes (one row per shape, the blob bytes
+    #  zero padded to whole 64 bit words), searched by Hamming distance: xor every row with the
+    #  query and count the set bits
+    #  a few thousand shapes is a few hundred kB, which numpy scans in well under a millisecond,
+    #  so there's no tree or hash table to keep balanced and inserts are just appends
+    
+    def __init__(self, displayID):
+        self.displayID = int(displayID)
+        self.lock = threading.Lock()
+        rows = query("SELECT shapeID, shapeBits, shapeFull FROM shapeTable WHERE DisplayID=? ORDER BY shapeID", (self.displayID,))
+        routing = get_routing(self.displayID)
+        self.nBits = rows[0][1] if rows else routing.nPins if routing is not None else 0
+        self.nBytes = (self.nBits + 63) // 64 * 8
+        self.IDs = np.array([row[0] for row in rows], dtype=np.int64)
+        self.rows = self.pack([row[2] for row in rows])
+    
+    def pack(self, blobs):
+        # blobs as a uint64 matrix, one shape per row
+        if not len(blobs):
+            return np.zeros((0, self.nBytes // 8), dtype=np.uint64)
+        return np.frombuffer(b''.join([bytes(blob).ljust(self.nBytes, b'\0') for blob in blobs]),
+                             dtype=np.uint64).reshape(len(blobs), self.nBytes // 8)
+    
+    def add(self, IDs, blobs):
+        with self.lock:
+            self.IDs = np.append(self.IDs, np.array(IDs, dtype=np.int64))
+            self.rows = np.vstack([self.rows, self.pack(blobs)])
+    
+    def distances(self, blob, rows=None):
+        # Hamming distance from blob to every shape (or the given rows)
+        rows = self.rows if rows is None else rows
+        return popcount(rows ^ self.pack([blob]))
+    
+    def nearest(self, blob, k=10, exclude=None):
+        # the k closest shapes as [ID, distance], closest first
+        with self.lock:
+            IDs, dists = self.IDs, self.distances(blob)
+        if exclude is not None:
+            IDs, dists = IDs[IDs != exclude], dists[IDs != exclude]
+        order = np.lexsort((IDs, dists))[:k]
+        return [[int(IDs[i]), int(dists[i])] for i in order]
+    
+    def within(self, blob, maxDistance, minDistance=0, exclude=None):
+        # every shape minDistance..maxDistance pistons away, closest first
+        with self.lock:
+            IDs, dists = self.IDs, self.distances(blob)
+        keep = (dists >= minDistance) & (dists <= maxDistance)
+        if exclude is not None:
+            keep &= IDs != exclude
+        IDs, dists = IDs[keep], dists[keep]
+        order = np.lexsort((IDs, dists))
+        return [[int(IDs[i]), int(dists[i])] for i in order]
+    
+    def novel(self, blobs, minDistance):
+        # indices of the blobs at least minDistance from the library and from each earlier kept blob
+        with self.lock:
+            library = self.rows
+        candidates = self.pack(blobs)
+        keep = []
+        for i, blob in enumerate(blobs):
+            if len(library) and self.distances(blob, library).min() < minDistance:
+                continue
+            if keep and self.distances(blob, candidates[keep]).min() < minDistance:
+                continue
+            keep.append(i)
+        return keep
+    
+    def duplicates(self, maxDistance=0):
+        # groups of shapes within maxDistance of the group's first (lowest) ID, groups of one left out
+        with self.lock:
+            IDs, rows = self.IDs, self.rows
+        order = np.argsort(IDs)
+        IDs, rows = IDs[order], rows[order]
+        if maxDistance == 0:
+            # exact repeats, just sort the rows
+            unique, inverse = np.unique(rows, axis=0, return_inverse=True)
+            groups = [IDs[inverse.ravel() == u].tolist() for u in np.flatnonzero(np.bincount(inverse.ravel()) > 1)]
+            return sorted(groups)
+        grouped = np.zeros(len(IDs), dtype=bool)
+        groups = []
+        block = 256   # rows whose distances to everything are worked out together
+        for start in range(0, len(IDs), block):
+            near = popcount(rows[start:start+block, None, :] ^ rows[None, :, :]) <= maxDistance
+            for i in range(start, min(start + block, len(IDs))):
+                if grouped[i]:
+                    continue
+                close = np.flatnonzero(near[i - start, i+1:] & ~grouped[i+1:]) + i + 1
+                if len(close):
+                    grouped[close] = True
+                    groups.append([int(IDs[i])] + IDs[close].tolist())
+        return groups
+
+
+shapeIndexLock = threading.Lock()
+
+def shape_index(displayID):
+    # the display's ShapeIndex, built on first use and dropped by forget_display_caches
+    displayID = int(displayID)
+    with shapeIndexLock:
+        index = shapeIndexes.get(displayID)
+        if index is None:
+            index = shapeIndexes[displayID] = ShapeIndex(displayID)
+        return index
+
+
+def search_shapes(displayID, shapeID=None, shape=None, k=10, minDistance=None, maxDistance=None):
+    ## shapes on a display close to a stored shape (shapeID) or a PackedShape, as [[ID, distance], ...]
+    #  the k nearest, or with minDistance/maxDistance every shape in that range
+    index = shape_index(displayID)
+    if shapeID is not None:
+        shapeID = int(shapeID)
+        found = load_shape(shapeID)
+        if found is None:
+            raise ValueError('no shape ' + str(shapeID))
+        shape = found[0]
+    if shape is None or len(shape) != index.nBits:
+        raise ValueError('shape is different length than number of pistons')
+    if minDistance is None and maxDistance is None:
+        return index.nearest(shape.blob, int(k), exclude=shapeID)
+    return index.within(shape.blob, index.nBits if maxDistance is None else int(maxDistance),
+                        int(minDistance or 0), exclude=shapeID)
+
+
+def add_arms(outward, fingerStarts, active, rng=np.random):
+    # from each starting piston, random walk outward until we hit the edge, raising pistons as we go
     
     for i in fingerStarts:
-        q, r, s = qrs[i,0:3]
-        
-        cont = 1     
-        while cont == 1:
-            # there are 6 pistons surrounding this
-            # check each one to see if it's (a) further away and (b) in the array
-            
-            # these are the 6 neighboring pistons
-            qrsOptions = np.array([[q+1, r-1, s], [q-1, r+1, s],[q-1, r, s+1],[q+1, r, s-1], [q, r+1, s-1], [q, r-1, s+1]])
-            
-            # indices of qrsOptions that are beside or outside the current pin
-            notIn = np.where(np.sum(np.abs(qrsOptions),1) >= (abs(q) + abs(r) + abs(s)))
-                        
-            # check each of the 4 or 5 remaining options to see if it's in the array
-            # if so, add it to a list from which we will randomly select one
-            options = []
-            for ii in notIn[0]:
-                if check_neighbor(qrs, qrsOptions[ii,0], qrsOptions[ii,1], qrsOptions[ii,2]):
-                    options.append(ii)
+        while True:
+            # neighbors that are beside or outside the current pin and in the array
+            options = outward[i]
                     
             # if we're on the edge
             if len(options) < 3:
-                cont = 0
-                continue
+                break
                
             # randomly choose one of the options and move there
-            newPositionQRS = qrsOptions[np.random.choice(options)]
-            q, r, s = newPositionQRS
-            newIndex = np.where(np.logical_and(qrs[:,0]==q, qrs[:,1]==r, qrs[:,2]==s))[0][0]
-            
-            # update this position to being active
-            binary = binary[:newIndex] + '1' + binary[newIndex+1:] 
+            i = rng.choice(options)
+            active[i] = True
         
-    return binary
+    return active
 
 
-def remove_fingers(qrs, binary, minNeighbors=1):
-    # recursively check any active piston to make sure it has at least minNeighbors neighbors
-    
-    keepGoing = True
-    while keepGoing:
+def neighbor_counts(neighbors, active):
+    # number of active neighbors for every piston, missing neighbors (-1) index the False pad at the end
+    return np.append(active, False)[neighbors].sum(1)
 
-        # get the addresses of pistons that are active and inactive for this shape
-        qrsActive = qrs[[m.start() for m in re.finditer('1', binary)]]
-        qrsInactive = qrs[[m.start() for m in re.finditer('0', binary)]]
-        
-        pistonsChanging = 0
-        for i in range(len(qrsActive)):
-            q, r, s = qrsActive[i,0:3]
-            
-            ns = 0
-            ns += check_neighbor(qrsActive, q-1, r+1, s)
-            ns += check_neighbor(qrsActive, q+1, r-1, s)
-            ns += check_neighbor(qrsActive, q-1, r, s+1)
-            ns += check_neighbor(qrsActive, q+1, r, s-1)
-            ns += check_neighbor(qrsActive, q, r+1, s-1)
-            ns += check_neighbor(qrsActive, q, r-1, s+1)
-            
-            if ns <= minNeighbors:
-                pistonsChanging += 1
-                # find position in binary (s) corresponding to this qrs address and change it to 1     
-                ind = int(np.argwhere(np.logical_and(qrs[:,0]==q, qrs[:,1]==r, qrs[:,2]==s)))
-                binary = binary[:ind] + '0' + binary[ind+1:] 
-
-        if pistonsChanging == 0:
-            keepGoing = False
-            
-    return binary
-    
+
+def remove_fingers(neighbors, active, minNeighbors=1):
+    # repeatedly drop any active piston that has minNeighbors or fewer active neighbors
     
+    while True:
+        dropping = active & (neighbor_counts(neighbors, active) <= minNeighbors)
+        if not dropping.any():
+            return active
+        active &= ~dropping
 
 
-def fill_holes(qrs, binary, minNeighbors = 4):
-    # recursively check any inactive piston to make sure it has at most minNeighbors neighbors
+def fill_holes(neighbors, active, minNeighbors = 4):
+    # repeatedly raise any inactive piston that has at least minNeighbors active neighbors
     # TODO: this wont fill large holes sometimes found in large displays
     
-    keepGoing = True
-    while keepGoing:
-
-        # get the addresses of pistons that are active and inactive for this shape
-        qrsActive = qrs[[m.start() for m in re.finditer('1', binary)]]
-        qrsInactive = qrs[[m.start() for m in re.finditer('0', binary)]]
-        
-        pistonsChanging = 0
-        for i in range(len(qrsInactive)):
-            q, r, s = qrsInactive[i,0:3]
-            
-            ns = 0
-            ns += check_neighbor(qrsActive, q-1, r+1, s)
-            ns += check_neighbor(qrsActive, q+1, r-1, s)
-            ns += check_neighbor(qrsActive, q-1, r, s+1)
-            ns += check_neighbor(qrsActive, q+1, r, s-1)
-            ns += check_neighbor(qrsActive, q, r+1, s-1)
-            ns += check_neighbor(qrsActive, q, r-1, s+1)
-            
-            if ns >= minNeighbors:
-                pistonsChanging += 1
-                # find position in binary (s) corresponding to this qrs address and change it to 1     
-                ind = int(np.argwhere(np.logical_and(qrs[:,0]==q, qrs[:,1]==r, qrs[:,2]==s)))
-                binary = binary[:ind] + '1' + binary[ind+1:] 
-
-        if pistonsChanging == 0:
-            keepGoing = False
-            
-    return binary
+    while True:
+        filling = ~active & (neighbor_counts(neighbors, active) >= minNeighbors)
+        if not filling.any():
+            return active
+        active |= filling
+
+migrate_DB()
+local_copy_DB()
+
+
+
+class SocketClient:
+    ## one websocket client with its own sender thread, so a slow or dead client never holds up a request
+    #  replies (pong, echo) wait in a bounded queue; display states don't queue, each one replaces the
+    #  last unsent one, so a client that falls behind just gets the latest state
+    #  subclasses can send some other way by overriding start, _wake and close (see Grasp3ServerAsync)
+    
+    def __init__(self, ws, fmt='string', protocol=1, maxQueue=64):
+        self.ws = ws
+        self.fmt = fmt
+        self.protocol = protocol
+        self.replies = collections.deque(maxlen=maxQueue)   # oldest dropped if the client stops reading
+        self.state = None                                   # latest state not yet sent
+        self.cond = threading.Condition()
+        self.alive = True
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def send(self, message):
+        with self.cond:
+            self.replies.append(message)
+            self._wake()
+    
+    def send_state(self, message, fallback=None):
+        # fallback replaces message if an earlier state is still unsent, e.g. a snapshot standing in
+        # for a delta that only makes sense on top of the state the client hasn't had yet
+        with self.cond:
+            self.state = fallback if self.state is not None and fallback is not None else message
+            self._wake()
+    
+    def close(self):
+        with self.cond:
+            self.alive = False
+            self._wake()
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+    
+    def _wake(self):
+        # called with cond held whenever there's something new to send
+        self.cond.notify()
+    
+    def _next(self):
+        # called with cond held: the next message to send, or None if there's nothing
+        if self.replies:
+            return self.replies.popleft()
+        message, self.state = self.state, None
+        return message
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.alive and not self.replies and self.state is None:
+                    self.cond.wait()
+                if not self.alive:
+                    return
+                message = self._next()
+            try:
+                self.ws.send(message)
+            except Exception:
+                metrics.count('ws_send_errors')
+                hub.remove(self)
+                return
+
+
+class BroadcastHub:
+    ## the connected websocket clients. broadcasting only hands the message to each client's sender
+    #  thread, so it returns straight away however many clients there are
+    
+    def __init__(self):
+        self.clients = []
+        self.lock = threading.Lock()
+    
+    def add(self, ws, fmt='string', protocol=1, cls=SocketClient):
+        # started before it's listed, so a broadcast from another thread never finds it half set up
+        # (AsyncSocketClient only has its loop once started)
+        client = cls(ws, fmt, protocol)
+        client.start()
+        with self.lock:
+            self.clients.append(client)
+        return client
+    
+    def remove(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
 
-global dest
-source = sqlite3.connect(dbFile)
-dest = sqlite3.connect(':memory:', check_same_thread=False)
-source.backup(dest)
-source.close()
+    def snapshot(self):
+        with self.lock:
+            return list(self.clients)
+    
+    def broadcast(self, message, fmt=None):
+        for client in self.snapshot():
+            if client.protocol == 1 and (fmt is None or client.fmt == fmt):
+                client.send_state(message)
 
 
+hub = BroadcastHub()
 
-def broadcast(message = "test"):
-    # send message to all connected websocket clients
-    # if there's an error, remove that connection from the list
-    for ws in socketConns:
-        try:
-            ws.send(message)
-        except:
-            socketConns.remove(ws)
+def broadcast(message = "test", fmt=None):
+    # send message to all connected (protocol 1) websocket clients, or just those that asked for fmt
+    hub.broadcast(message, fmt)
             
 def broadcastDisplay():
-    global activeDisplay, activePistons
+    ## tell every websocket client about the current display state
+    #  protocol 1 clients get the whole state every time
+    #  protocol 2 clients get a numbered delta against the previous state when that's smaller
+    #  the state is read once and kept as lastState, so every message (and later snapshots) agree
+    #  with the seq they carry even if the globals change again while we're sending
+    global stateSeq, lastState
     if activeDisplay:
-        broadcast('{"activeDisplay":' + str(activeDisplay) + ', "activeShape":' + str(activeShape) + ', "activePistons":"' + activePistons + '"}')
+        with metrics.timer('broadcast_seconds'), stateLock:
+            stateSeq += 1
+            previous, lastState = lastState, (activeDisplay, activeShape, activePistons)
+            
+            messages = {}
+            for client in hub.snapshot():
+                key = (client.protocol, client.fmt)
+                if key not in messages:
+                    if client.protocol == 2:
+                        snapshot = snapshot_message(lastState, client.fmt)
+                        delta = delta_message(previous, lastState)
+                        messages[key] = (delta, snapshot) if delta is not None and len(delta) < len(snapshot) else (snapshot, None)
+                    else:
+                        messages[key] = (display_message(lastState, client.fmt), None)
+                client.send_state(*messages[key])
     else:
         print('No active displays')
 
+def display_message(state, fmt='string'):
+    # a (display, shape, pistons) state as sent over the websocket
+    # 'packed' clients get the pistons as base64 bits, everyone else the old '0'/'1' string
+    if fmt == 'packed':
+        return json.dumps(packed_state(state))
+    display, shape, pistons = state
+    pistons = pistons.to_string() if pistons is not None else '0'
+    return '{"activeDisplay":' + str(display) + ', "activeShape":' + str(shape) + ', "activePistons":"' + pistons + '"}'
+
+def packed_state(state):
+    # a (display, shape, pistons) state with the pistons as base64 bits, for clients that asked for format=packed
+    display, shape, pistons = state
+    return {'activeDisplay': int(display), 'activeShape': int(shape),
+            'nPins': len(pistons) if pistons is not None else 0,
+            'activePistonsB64': pistons.to_b64() if pistons is not None else ''}
+
+def snapshot_message(state, fmt='string'):
+    # protocol 2 full state, numbered with the current stateSeq. Only call with lastState, under stateLock
+    message = packed_state(state)
+    if fmt != 'packed':
+        del message['activePistonsB64']
+        message['activePistons'] = state[2].to_string() if state[2] is not None else ''
+    return json.dumps(dict(type='snapshot', seq=stateSeq, **message))
+
+def delta_message(previous, state):
+    # protocol 2 change from the previous broadcast state to this one, as [start, length] runs of pistons to flip
+    # None if the change can't be expressed as a delta (new display, unknown pistons)
+    display, shape, pistons = state
+    if previous is None or pistons is None or previous[2] is None:
+        return None
+    if previous[0] != display or len(previous[2]) != len(pistons):
+        return None
+    changed = np.concatenate(([False], previous[2].bits ^ pistons.bits, [False]))
+    edges = np.flatnonzero(changed[1:] != changed[:-1])
+    runs = np.column_stack((edges[::2], edges[1::2] - edges[::2])).tolist()
+    return json.dumps({'type': 'delta', 'seq': stateSeq, 'activeShape': int(shape), 'flip': runs})
+
+def send_snapshot(client):
+    # bring one protocol 2 client up to date with the last broadcast, replacing anything it hasn't been sent yet
+    # (not the live globals: those can be ahead of the last broadcast, and the next delta is taken from it)
+    with stateLock:
+        if lastState is not None and lastState[0]:
+            client.send_state(snapshot_message(lastState, client.fmt))
+
 
 @sock.route('/')
 def echo(ws):
     # When a websocket connection is made from a client, add that WS connection
-    # to my list 'socketConns' that will be used for broadcasting
+    # to the hub that will be used for broadcasting
     # also echo back whatever the client sends
+    # connect to /?format=packed to get pistons as base64 bits instead of a '0'/'1' string
+    # connect with ?protocol=2 for numbered snapshot + delta messages: apply each delta's flip runs
+    # to the pistons, and if a seq is skipped send 'resync' to get a fresh snapshot
+    
+    protocol = 2 if request.args.get('protocol') == '2' else 1
+    client = hub.add(ws, 'packed' if request.args.get('format') == 'packed' else 'string', protocol)
+    welcome(client)
     
-    socketConns.append(ws)
+    try:
+        while client.alive:
+            data = ws.receive()
+            socket_message(client, data)
+    finally:
+        hub.remove(client)
+
+
+def welcome(client):
+    # first message for a newly connected websocket client
+    if client.protocol == 2:
+        send_snapshot(client)
+    else:
+        with stateLock:
+            if lastState is not None and lastState[0]:
+                client.send_state(display_message(lastState, client.fmt))
+
+def socket_message(client, data):
+    # handle something a websocket client sent us
+    print(data)
+    
+    if data == 'ping':
+        client.send('__pong__')
+        print('got a ping')
+    elif data == 'resync' and client.protocol == 2:
+        send_snapshot(client)
+    else:
+        client.send(data)
+
+
+def select_display(displayID, passiveUpdate):
+    # make displayID the active display and tell the websocket clients
+    global activeDisplay, activePistons
+    activeDisplay = displayID  
+    if not passiveUpdate:
+        activePistons = None   # when client actively changes shape, reset activePistons
     broadcastDisplay()
 
-    while True:
-        data = ws.receive()
-        print(data)
+
+def show_display(displayID, passiveUpdate):
+    ## make displayID the active display and return its geometry
+    select_display(displayID, passiveUpdate)
+    return dict(display_geometry(displayID).payload)
+
+
+class DisplayGeometry:
+    ## a display's /display response, serialized and gzipped once. Geometry only changes when a display
+    #  is created, imported or restored, and all of those go through forget_display_caches
+    #  the ETag is a hash of the body, so a display ID that's reused after a delete gets a new one
+    
+    def __init__(self, payload, xys=()):
+        self.payload = payload
+        self.xys = np.array(xys, dtype=float).reshape(-1, 4)   # piston, x, y, AlwaysUp in piston order, for previews
+        self.body = json.dumps(payload, separators=(',', ':')).encode()
+        self.gzipped = gzip.compress(self.body, 6)
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+    
+    def response(self, ifNoneMatch=None, acceptEncoding=None):
+        ## (status, body, headers) for a request with these If-None-Match and Accept-Encoding headers
+        #  each encoding gets its own ETag, as they're different bytes. no-cache has the browser check
+        #  back every time, which costs a 304 and nothing else
+        gz = 'gzip' in (acceptEncoding or '')
+        etag = self.etag[:-1] + '-gz"' if gz else self.etag
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding',
+                   "Access-Control-Allow-Origin": "*"}
+        tags = [tag.strip().replace('W/', '', 1) for tag in (ifNoneMatch or '').split(',')]
+        if etag in tags or '*' in tags:
+            metrics.count('display_geometry', result='304')
+            return 304, b'', headers
+        metrics.count('display_geometry', result='200')
+        headers['Content-Type'] = 'application/json'
+        if gz:
+            headers['Content-Encoding'] = 'gzip'
+            return 200, self.gzipped, headers
+        return 200, self.body, headers
+
+
+def display_geometry(displayID):
+    # the DisplayGeometry for displayID, made on first use. xys stays a JSON string inside the JSON,
+    # as the clients expect
+    displayID = int(displayID)
+    geometry = geometryCache.get(displayID)
+    if geometry is None:
+        xys = get_hex_array(displayID, 'xy')
+        hap = get_hex_array_props(displayID)
+        geometry = geometryCache[displayID] = DisplayGeometry(
+            dict(xys=json.dumps(xys), nPins=hap[0][0], rMin=hap[0][1], rMax=hap[0][2], pistonR=hap[0][3]), xys)
+    return geometry
+
+
+class PreviewRenderer:
+    ## draws shapes on one display's layout, the way plotHapticDisplay did: down pistons as outlines of
+    #  pistonR, up pistons filled at 1.8x that, rMin in black and rMax in red
+    #  everything that depends only on the layout is worked out once here: for png, which (supersampled)
+    #  pixels each piston's disk and outline cover; for svg, each piston's circle in both states. A shape
+    #  then costs a couple of numpy index operations, so batches of thumbnails go quickly
+    #  (matplotlib's Agg and svg backends took 30 ms and 280 ms a shape drawing the same pistons)
+    
+    def __init__(self, geometry, size):
+        props = geometry.payload
+        xy = geometry.xys[:, 1:3]
+        r = props['pistonR']
+        self.size = size
+        self.ss = 2 if size <= 512 else 1   # supersampling for smooth edges
+        self.extent = max(props['rMax'], np.abs(xy).max() + 1.8 * r if len(xy) else 0) * 1.05
+        
+        # png: pixel coverage as (pixel, piston) pairs for the up disks and the down outlines
+        n = self.size * self.ss
+        scale = n / (2 * self.extent)   # pixels per mm
+        centers = np.stack([xy[:, 0], -xy[:, 1]], axis=1) * scale + n / 2.   # image y runs down
+        rUp, rDown, width = 1.8 * r * scale, r * scale, max(self.ss, 0.15 * r * scale)
+        reach = int(np.ceil(rUp)) + 1
+        offsets = np.arange(-reach, reach + 1)
+        px = np.floor(centers[:, :1]).astype(np.int32) + offsets   # (n, k) columns near each piston
+        py = np.floor(centers[:, 1:]).astype(np.int32) + offsets   # (n, k) rows
+        dist = np.hypot(px[:, None, :] + 0.5 - centers[:, :1, None], py[:, :, None] + 0.5 - centers[:, 1:, None])
+        inside = (px[:, None, :] >= 0) & (px[:, None, :] < n) & (py[:, :, None] >= 0) & (py[:, :, None] < n)
+        pixel = (py[:, :, None] * n + px[:, None, :]).astype(np.int32)
+        piston = np.broadcast_to(np.arange(len(xy), dtype=np.int32)[:, None, None], pixel.shape)
+        up = inside & (dist <= rUp)
+        ring = inside & (np.abs(dist - rDown) <= width / 2.)
+        self.upPixel, self.upPiston = pixel[up], piston[up]
+        self.ringPixel, self.ringPiston = pixel[ring], piston[ring]
+        
+        # the rMin and rMax circles never change
+        yy, xx = np.mgrid[0:n, 0:n] + 0.5 - n / 2.
+        rad = np.hypot(xx, yy).ravel()
+        self.black = np.abs(rad - props['rMin'] * scale) <= width / 2.
+        self.red = np.abs(rad - props['rMax'] * scale) <= width / 2.
         
-        if data == 'ping':
-            ws.send('__pong__')
-            print('got a ping')
+        # svg: each piston's circle as text, up and down
+        unit = lambda v: np.char.mod('%.3f', v)
+        cx, cy = unit(xy[:, 0]), unit(-xy[:, 1])
+        self.svgDown = np.char.add(np.char.add(np.char.add(np.char.add('<circle cx="', cx), '" cy="'), cy), '" r="%.3f" class="d"/>' % r)
+        self.svgUp = np.char.add(np.char.add(np.char.add(np.char.add('<circle cx="', cx), '" cy="'), cy), '" r="%.3f" class="u"/>' % (1.8 * r))
+        e, w = self.extent, 0.15 * r
+        self.svgHead = ('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="%.3f %.3f %.3f %.3f">'
+                        '<style>.d{fill:none;stroke:#000;stroke-width:%.3f}.u{fill:#000}</style><rect x="%.3f" y="%.3f" width="%.3f" height="%.3f" fill="#fff"/>'
+                        '<circle r="%.3f" fill="none" stroke="#000" stroke-width="%.3f"/><circle r="%.3f" fill="none" stroke="#f00" stroke-width="%.3f"/>'
+                        % (size, size, -e, -e, 2 * e, 2 * e, w, -e, -e, 2 * e, 2 * e, props['rMin'], w, props['rMax'], w))
+    
+    def render(self, bits, fmt='png'):
+        # image bytes for a shape's bits (bits[i] is piston i)
+        bits = np.asarray(bits, dtype=bool)
+        if fmt == 'svg':
+            return (self.svgHead + ''.join(np.where(bits, self.svgUp, self.svgDown)) + '</svg>').encode()
+        
+        dark = self.black.copy()
+        dark[self.upPixel[bits[self.upPiston]]] = True
+        dark[self.ringPixel[~bits[self.ringPiston]]] = True
+        red = self.red & ~dark
+        
+        # average each ss x ss block down to one pixel by adding up strided slices
+        n, ss = self.size, self.ss
+        dark, red = dark.reshape(n * ss, n * ss), red.reshape(n * ss, n * ss)
+        darkN = sum([dark[i::ss, j::ss].astype(np.uint16) for i in range(ss) for j in range(ss)]) * 255 // ss**2
+        redN = sum([red[i::ss, j::ss].astype(np.uint16) for i in range(ss) for j in range(ss)]) * 255 // ss**2
+        rgb = np.empty((n, n, 3), dtype=np.uint8)
+        rgb[:, :, 0] = 255 - darkN
+        rgb[:, :, 1] = rgb[:, :, 2] = 255 - darkN - redN
+        return png_bytes(rgb)
+
+
+def png_bytes(rgb):
+    # encode an (h, w, 3) uint8 array as a png, no filtering
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    h, w = rgb.shape[:2]
+    rows = np.concatenate([np.zeros((h, 1), dtype=np.uint8), rgb.reshape(h, w * 3)], axis=1)   # filter byte 0 a row
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+def shape_preview(shapeID, size=256, fmt='png', shape=None, renderers=None):
+    ## (image bytes, key, rendered) for shape shapeID drawn at size x size pixels, as png or svg
+    #  images are cached in previewDir under a key made from the shape's bits, its display's geometry and
+    #  the render settings, so a changed shape or display (or a reused shapeID) never gets a stale picture
+    #  rendered is False when the image came from the cache. Batches pass in the shape and a dict to keep
+    #  their PreviewRenderers in. Raises ValueError for bad settings or a missing shape
+    if fmt not in previewFormats:
+        raise ValueError('format must be one of ' + ', '.join(previewFormats))
+    if not 16 <= int(size) <= 1024:
+        raise ValueError('size must be 16 to 1024 pixels')
+    size = int(size)
+    shape = shape or load_shape(shapeID)
+    if shape is None:
+        raise ValueError('no shape ' + str(shapeID))
+    pistons, displayID = shape
+    geometry = display_geometry(displayID)
+    if len(geometry.xys) != len(pistons):
+        raise ValueError('shape ' + str(shapeID) + ' has ' + str(len(pistons)) + ' pistons, its display has ' + str(len(geometry.xys)))
+    
+    key = hashlib.sha1(pistons.blob + geometry.etag.encode() + (str(size) + fmt).encode()).hexdigest()[:20]
+    path = os.path.join(previewDir, 'shape' + str(int(shapeID)) + '_' + str(size) + '_' + key + '.' + fmt)
+    try:
+        with open(path, 'rb') as f:
+            metrics.count('shape_previews', result='cached')
+            return f.read(), key, False
+    except FileNotFoundError:
+        pass
+    
+    with metrics.timer('preview_seconds'):
+        renderers = {} if renderers is None else renderers
+        if (geometry.etag, size) not in renderers:
+            renderers[geometry.etag, size] = PreviewRenderer(geometry, size)
+        data = renderers[geometry.etag, size].render(pistons.bits, fmt)
+    metrics.count('shape_previews', result='rendered')
+    os.makedirs(previewDir, exist_ok=True)
+    part = path + '.' + str(threading.get_ident()) + '.part'   # written whole or not at all
+    with open(part, 'wb') as f:
+        f.write(data)
+    os.replace(part, path)
+    return data, key, True
+
+
+def preview_display(displayID, size=128, fmt='png'):
+    ## thumbnails for every shape on a display, all drawn with one figure. Shapes are read straight from
+    #  the replica so a big library doesn't flush load_shape's cache. Returns counts and time taken
+    t0 = time.perf_counter()
+    renderers = {}
+    rendered = cached = 0
+    for (shapeID,) in get_shape_IDs(displayID):
+        shape = fetch_shape(shapeID)
+        if shape is None:   # deleted since we listed them
+            continue
+        if shape_preview(shapeID, size, fmt, shape, renderers)[2]:
+            rendered += 1
         else:
-            ws.send(data)
+            cached += 1
+    return dict(displayID=int(displayID), rendered=rendered, cached=cached, seconds=time.perf_counter() - t0)
+
+
+def show_shape(ID, full=False, fmt='string'):
+    ## put shape ID on the display (0 blanks it), tell the websocket clients and return the result
+    #  full forces every channel to be written, fmt 'packed' returns the pistons as base64 bits
+    resp = put_shape(ID, full=full)
+    broadcastDisplay()
+    if str(ID) != '0' and prefetchAhead:
+        planPool.submit(prefetch_next_shapes, ID)
+    
+    # packed sends the pistons as base64 bits, otherwise the old '0'/'1' string
+    if fmt == 'packed':
+        result = dict(shapeB64=activePistons.to_b64(), nPins=len(activePistons))
+    else:
+        result = dict(shape=json.dumps(activePistons.to_string()))
+    result['redrawTime'] = lastRedraw.get('seconds')
+    if resp != "1":
+        result['error'] = resp
+    return result
+
+
+def put_shape(ID, pistons=None, displayID=None, full=False):
+    ## drive the PLCs to shape ID and make it the active shape, without telling anyone
+    #  pistons/displayID can be passed in when the shape has already been loaded
+    #  blanks (shape 0) go to displayID, or the active display if that isn't given
+    global activePistons, activeShape
+    activeShape = ID
+    
+    # shape 0 is for blanking out the display
+    if str(activeShape) == '0':
+        print('blanking out display...')
+        return blank_display(displayID or activeDisplay)
+    
+    # otherwise get the shape info and set the pistons accordingly
+    if pistons is None:
+        with metrics.timer('shape_load_seconds'):
+            pistons, displayID = load_shape(ID)
+    activePistons = pistons
+    return set_pistons_to_shape(pistons, displayID, force=full)
+
+
+def blank_display(displayID):
+    # drop every piston on the display with one all-low write per PLC
+    global activePistons
+    routing = get_routing(displayID)
+    if routing is None:
+        return 'failed to get piston addresses'
+    
+    t0 = time.perf_counter()
+    results = [(i+1, write_PLC(i+1, [(1, 2048)])) for i in range(routing.nPLCs)]
+    lastRedraw.update(displayID=displayID, seconds=time.perf_counter() - t0, PLCs=routing.nPLCs, buses=1)
+    metrics.observe('redraw_seconds', lastRedraw['seconds'], kind='blank')
+    activePistons = PackedShape.zeros(routing.nPins)
+    errors = [PLC_failure(PLC, nErrors) for PLC, nErrors in results if nErrors]
+    if any([nErrors is None for PLC, nErrors in results]):
+        errors.append('Lost connection to RS485 modem')
+    return '; '.join(errors) if errors else '1'
+
+
+def set_piston(displayID, piston, direction):
+    ## move one piston (or the vacuum, piston -1) up (1) or down (0)
+    # error checking on input
+    if not str(direction) == '0' and not str(direction) == '1':
+        return dict(error='Direction must be 0 or 1')
+
+    # First, get the info for the piston we want to change
+    # Check for special case of a request for the vacuum channel
+    routing = get_routing(displayID)
+    address = routing.address(piston) if routing is not None else None
+    if address is None:
+        return dict(error='Specified piston does not exist in db for this shape')
         
+    PLC_ID, PLC_Chan = address
+    print('plc: ' + str(PLC_ID) + ", chan: " + str(PLC_Chan) + ", direction: " + str(direction))
+    
+    # with a toggle window, wait for the rest of the burst and go out with it
+    if toggleWindow > 0:
+        return toggles.submit(routing, piston, address, direction)
+    
+    val = 512 - 256 * int(direction)  #512 for down, 256 for up
+    
+    # Second, send the request to the PLC
+    result = toggle_result(address, direction, write_PLC(PLC_ID, [(PLC_Chan, val)]))
+    
+    # Third, update the state and tell the websocket clients
+    note_toggle(routing, piston, direction)
+    broadcastDisplay()
+    return result
+
+
+def toggle_result(address, direction, nErrors):
+    # set_piston's answer for a toggle, given what write_PLC said about its PLC
+    if nErrors is None:
+        return dict(error="Couldn't connect to the RS485 modem, using simulation mode...")
+    elif nErrors:
+        return dict(error='PLC request failed')
+    return dict(PLCChan=json.dumps([address, direction]))
+
+def note_toggle(routing, piston, direction):
+    # a piston was moved by hand, so we're no longer showing a preset shape
+    global activePistons, activeShape
+    activeShape = 0
+    
+    # keep the pistons in step (piston numbers aren't shape positions, so go through the routing)
+    i = routing.index_of(piston)
+    if i is not None and activePistons is not None and len(activePistons) == routing.nPins:
+        activePistons = activePistons.with_piston(i, direction)
+
+
+class ToggleBatch:
+    # the toggles that arrived in one window
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.writes = {}     # PLC -> {chan: val}, a later toggle of the same channel replaces the earlier one
+        self.toggles = []    # (routing, piston, direction) in arrival order
+        self.errors = {}     # PLC -> what write_PLC returned
+        self.done = threading.Event()
+
+
+class ToggleCoalescer:
+    ## merges set_piston toggles that arrive within toggleWindow of the first one
+    #  each PLC gets one write for the lot (function 16 runs when that's cheaper), the state goes
+    #  out in one broadcast, and every request in the window is answered when that's done
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.batch = None
+        self.thread = None
+    
+    def submit(self, routing, piston, address, direction):
+        PLC, chan = address
+        with self.cond:
+            if self.batch is None:
+                self.batch = ToggleBatch(time.monotonic() + toggleWindow)
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='toggles', daemon=True)
+                    self.thread.start()
+                self.cond.notify()
+            batch = self.batch
+            batch.writes.setdefault(int(PLC), {})[int(chan)] = 512 - 256 * int(direction)
+            batch.toggles.append((routing, piston, direction))
+        batch.done.wait()
+        result = toggle_result(address, direction, batch.errors.get(int(PLC)))
+        result['batched'] = len(batch.toggles)
+        return result
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.batch is None:
+                    self.cond.wait()
+                deadline = self.batch.deadline
+            time.sleep(max(0., deadline - time.monotonic()))
+            with self.cond:
+                batch, self.batch = self.batch, None
+            try:
+                self._flush(batch)
+            finally:
+                batch.done.set()
+    
+    def _flush(self, batch):
+        metrics.count('toggle_batches')
+        metrics.count('toggles', len(batch.toggles))
+        for PLC, chans in batch.writes.items():
+            pins = np.array(sorted(chans))
+            vals = np.array([chans[pin] for pin in pins])
+            options = [[(int(pin), int(val)) for pin, val in zip(pins, vals)]]
+            if bulkWrites and PLC not in noBulkPLCs:
+                options.append(channel_runs(pins, vals))
+            batch.errors[PLC] = write_PLC(PLC, min(options, key=frame_cost))
+        
+        for routing, piston, direction in batch.toggles:
+            note_toggle(routing, piston, direction)
+        broadcastDisplay()
+
+toggles = ToggleCoalescer()
+
+
+def shape_search(displayID, args):
+    ## /shape_search: shapes on a display near a query shape, given as shapeID=, shapeB64= (format=packed
+    #  bits) or shape= ('0'/'1' string). k= for the k nearest (default 10), or minDistance= / maxDistance=
+    #  for every shape that many pistons away
+    try:
+        shape = None
+        if args.get('shapeB64') is not None:
+            shape = PackedShape.from_b64(shape_index(displayID).nBits, args['shapeB64'])
+        elif args.get('shape') is not None:
+            shape = PackedShape.from_string(args['shape'])
+        matches = search_shapes(displayID, args.get('shapeID'), shape, args.get('k', 10),
+                                args.get('minDistance'), args.get('maxDistance'))
+    except ValueError as e:
+        return dict(error=str(e))
+    return dict(matches=json.dumps(matches))
+
+
+def display_IDs():
+    # display IDs, plus an error if any of the RS485 converters can't be opened
+    IDs = get_display_IDs()
+    if not all([bus.is_open() for bus in list(buses.values())]):
+        print('failed to connect to modem')
+        return dict(DisplayIDs=json.dumps(IDs), error='Failed to connect to RS485 modem, using simulation mode...')
+    return dict(DisplayIDs=json.dumps(IDs))
+
+
+class ShapeSequence:
+    ## a list of (shapeID, hold seconds) steps for the scheduler to put on the display back to back
+    #  shapes are loaded when the sequence is made, so only the PLC writes are on the clock
+    #  onsets are scheduled from the sequence start, so a slow redraw doesn't push the later steps back
+    
+    def __init__(self, ID, steps, blank=0, full=False):
+        self.ID = ID
+        self.full = full
+        self.steps = []
+        for shapeID, hold in steps:
+            self.steps.append((int(shapeID), float(hold)))
+            if blank and int(shapeID) != 0:
+                self.steps.append((0, float(blank)))   # blank interval after every shape
+        if not self.steps:
+            raise ValueError('sequence has no steps')
+        if not all([math.isfinite(hold) and hold >= 0 for shapeID, hold in self.steps]):
+            raise ValueError('hold and blank times must be numbers of seconds, not negative')
         
+        self.shapes = {}   # shapeID -> (PackedShape, displayID)
+        for shapeID in set([shapeID for shapeID, hold in self.steps]) - {0}:
+            shape = load_shape(shapeID)
+            if shape is None:
+                raise ValueError('no shape ' + str(shapeID))
+            self.shapes[shapeID] = shape
+        # blanks go to the display the shapes are on
+        self.displayID = next(iter(self.shapes.values()))[1] if self.shapes else activeDisplay
+        
+        self.state = 'queued'
+        self.cancelled = threading.Event()
+        self.started = None   # wall clock time of the sequence start
+        self.onsets = []      # one dict per step that was put on the display
+    
+    def status(self):
+        return dict(sequenceID=self.ID, state=self.state, nSteps=len(self.steps), started=self.started,
+                    onsets=list(self.onsets))
+
+
+class SequenceScheduler:
+    ## plays ShapeSequences one after another on its own thread, timed on perf_counter
+    #  (monotonic, and fine grained on every platform) rather than by the client's requests
+    #  each step's onset is when its writes start going out, drawn when the last one is answered
+    
+    def __init__(self, keep=100):
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.sequences = collections.OrderedDict()   # the last keep sequences by ID, for status requests
+        self.keep = keep
+        self.nextID = 1
+        self.thread = None
+        self.priority = None   # what _raise_priority managed to get
+    
+    def submit(self, steps, blank=0, full=False):
+        seq = ShapeSequence(None, steps, blank, full)   # loads the shapes, raises ValueError for bad steps
+        with self.cond:
+            seq.ID = self.nextID
+            self.nextID += 1
+            self.sequences[seq.ID] = seq
+            while len(self.sequences) > self.keep:
+                self.sequences.popitem(last=False)
+            self.queue.append(seq)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='sequencer', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        # plan the whole sequence now, while it waits its turn
+        planPool.submit(prefetch_plans, seq.displayID,
+                        [seq.shapes[shapeID][0] if shapeID else None for shapeID, hold in seq.steps], True, seq.full)
+        return seq
+    
+    def get(self, ID):
+        with self.cond:
+            return self.sequences.get(int(ID))
+    
+    def cancel(self, ID):
+        seq = self.get(ID)
+        if seq is not None:
+            seq.cancelled.set()
+        return seq
+    
+    def _raise_priority(self):
+        # best effort, both of these need privileges and neither exists everywhere
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))   # on Linux, 0 is this thread
+            self.priority = 'SCHED_FIFO'
+        except (AttributeError, OSError):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -10)
+                self.priority = 'nice -10'
+            except (AttributeError, OSError):
+                self.priority = 'normal'
+        print('sequencer running at ' + self.priority + ' priority')
+    
+    def _run(self):
+        self._raise_priority()
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                seq = self.queue.popleft()
+            try:
+                self._play(seq)
+            except Exception as e:
+                print('sequence ' + str(seq.ID) + ' failed: ' + str(e))
+                seq.state = 'failed'
+    
+    def _play(self, seq):
+        if seq.cancelled.is_set():
+            seq.state = 'cancelled'
+            return
+        seq.state = 'running'
+        t0 = time.perf_counter() + sequenceLead
+        wallOffset = time.time() - time.perf_counter()   # turns perf_counter readings into epoch seconds
+        seq.started = t0 + wallOffset
+        
+        target = t0
+        for shapeID, hold in seq.steps:
+            if wait_until(target, seq.cancelled):
+                seq.state = 'cancelled'
+                return
+            onset = time.perf_counter()
+            pistons, displayID = seq.shapes.get(shapeID, (None, seq.displayID))
+            resp = put_shape(shapeID, pistons, displayID, seq.full)
+            drawn = time.perf_counter()
+            broadcastDisplay()
+            
+            step = dict(shapeID=shapeID, hold=hold, target=target - t0, onset=onset - t0,
+                        late=onset - target, drawn=drawn - t0, onsetTime=onset + wallOffset)
+            if resp != '1':
+                step['error'] = resp
+            seq.onsets.append(step)
+            target += hold
+        
+        # the last shape gets its hold too before the next sequence can start
+        seq.state = 'cancelled' if wait_until(target, seq.cancelled) else 'done'
+
+
+def wait_until(deadline, cancelled):
+    # wait for perf_counter to reach deadline, True if cancelled got set first
+    # sleeps for most of the wait, then spins for the last spinWindow to cut the wake up jitter
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return cancelled.is_set()
+        if remaining > spinWindow:
+            if cancelled.wait(remaining - spinWindow):
+                return True
+        else:
+            if cancelled.is_set():
+                return True
+            time.sleep(0)   # let other threads have the GIL while we spin
+
+sequencer = SequenceScheduler()
+
+def start_sequence(params):
+    # queue a sequence from request parameters, see the /sequence route
+    if not isinstance(params, dict):
+        return dict(error='sequence must be an object with steps')
+    try:
+        seq = sequencer.submit(params.get('steps', []), params.get('blank', 0), bool(params.get('full', False)))
+    except (ValueError, TypeError) as e:
+        return dict(error=str(e))
+    return seq.status()
+
+
+def rs485_status():
+    # health of each converter, plus what the simulated buses have been doing when GRASP3_SIM is set
+    status = dict(buses=[bus.status() for bus in list(buses.values())])
+    if simConfig is not None:
+        status['simulated'] = [Grasp3Sim.sim_bus(bus.port, **Grasp3Sim.parse_config(simConfig)).status() for bus in list(buses.values())]
+    return status
+
+
+def metrics_report():
+    # /metrics as JSON: the counters and histograms plus a few things worth seeing next to them
+    report = metrics.snapshot()
+    report.update(wsClients=len(hub.snapshot()), planCache=dict(planStats), lastRedraw=dict(lastRedraw))
+    return report
+
+
+@app.before_request
+def start_request_timer():
+    request.metricsStart = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    # time and count every request by route
+    if metrics.enabled and hasattr(request, 'metricsStart'):
+        endpoint = request.endpoint or 'unmatched'   # 404s and 405s have no endpoint
+        metrics.observe('http_seconds', time.perf_counter() - request.metricsStart, endpoint=endpoint)
+        metrics.count('http_requests', endpoint=endpoint, status=response.status_code)
+    return response
 
 
 @app.route('/')
@@ -587,30 +2504,24 @@ def index():
 @app.route('/display/<displayID>/<passiveUpdate>', methods = ['GET', 'POST', 'DELETE'])
 def display(displayID, passiveUpdate):
     if request.method == 'GET':
-        global activeDisplay, activePistons
-        activeDisplay = displayID  
-        if not passiveUpdate:
-            activePistons = '0'   # when client actively changes shape, reset activePistons
-        broadcastDisplay()
-        
-        xys = get_hex_array(displayID, 'xy')
-        hap = get_hex_array_props(displayID)
-        
-        response = jsonify(xys=json.dumps(xys), nPins=hap[0][0], rMin=hap[0][1], rMax=hap[0][2], pistonR=hap[0][3])
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        return response
+        # the geometry is sent ready made, or as a 304 if the client already has it
+        select_display(displayID, passiveUpdate)
+        status, body, headers = display_geometry(displayID).response(request.headers.get('If-None-Match'),
+                                                                     request.headers.get('Accept-Encoding'))
+        return Response(body, status, headers)
         
     
     elif request.method == 'POST':
-        rMin = float(request.form.get('rMin'))
-        rAlwaysUp = float(request.form.get('rAlwaysUp'))
-        rMax = float(request.form.get('rMax'))
-        pistonR = float(request.form.get('pistonR'))
-        pistonPitch = float(request.form.get('pistonPitch'))
-        
-        dispID = create_hex_array(rMin, rAlwaysUp, rMax, pistonR, pistonPitch)
-        
-        response = jsonify(displayID=json.dumps(dispID))
+        try:
+            rMin = float(request.form.get('rMin'))
+            rAlwaysUp = float(request.form.get('rAlwaysUp'))
+            rMax = float(request.form.get('rMax'))
+            pistonR = float(request.form.get('pistonR'))
+            pistonPitch = float(request.form.get('pistonPitch'))
+            
+            response = jsonify(displayID=json.dumps(create_hex_array(rMin, rAlwaysUp, rMax, pistonR, pistonPitch)))
+        except (ValueError, TypeError) as e:   # TypeError for a missing field
+            response = jsonify(error=str(e))
         response.headers.add("Access-Control-Allow-Origin", "*")
         return response
 
@@ -618,37 +2529,23 @@ def display(displayID, passiveUpdate):
         delete_hex_array(displayID)
         return "display deleted"
     
+@app.get('/display_preview')
+def display_preview():
+    # try out display settings without storing them, same query names as the POST /display form
+    try:
+        args = [float(request.args.get(key, default)) for key, default in
+                (('rMin', 5), ('rAlwaysUp', 7), ('rMax', 25), ('pistonR', 1.1), ('pistonPitch', 3.4))]
+        response = jsonify(**preview_hex_array(*args))
+    except ValueError as e:
+        response = jsonify(error=str(e))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
+    
 @app.route('/shape/<ID>', methods = ['GET', 'POST', 'DELETE'])
 def shape(ID):
     if request.method == 'GET':
-        global activePistons, activeShape
-        activeShape = ID
-        
-        # shape 0 is for blanking out the display
-        if activeShape == '0':
-            print('blanking out display...')
-            
-            # figure out how many PLCs we need to blank out
-            global activeDisplay
-            cmd = f"SELECT nPLCs FROM displayPropsTable WHERE DisplayID={activeDisplay}"
-            nPLCs = dest.execute(cmd).fetchall()[0][0]
-
-            for i in range(nPLCs):
-                set_all_pistons(i+1, 0)
-            
-            resp = "1"
-        # otherwise get the shape info and set the pistons accordingly    
-        else:
-            activePistons, displayID = get_shape(ID)
-            resp = set_pistons_to_shape(activePistons, displayID)
-            
-        broadcastDisplay()
-        
-        if resp == "1":
-            response = jsonify(shape=json.dumps(activePistons))
-        else:
-            response = jsonify(shape=json.dumps(activePistons), error=resp)
-            
+        # ?full=1 rewrites every channel, ?format=packed returns the pistons as base64 bits
+        response = jsonify(**show_shape(ID, request.args.get('full') == '1', request.args.get('format', 'string')))
         response.headers.add("Access-Control-Allow-Origin", "*")
         return response
             
@@ -670,82 +2567,162 @@ def shape(ID):
         return "display deleted"
 
 
-@app.get('/get_display_IDs')
-def get_display_IDsHTTP():
-    IDs = get_display_IDs()
-    client = connect_RS485()
-    if not client:
-        print('failed to connect to modem')
-        response = jsonify(DisplayIDs=json.dumps(IDs), error='Failed to connect to RS485 modem, using simulation mode...')
-    else:
-        response = jsonify(DisplayIDs=json.dumps(IDs))
+@app.post('/shape_batch')
+def shape_batch():
+    # generate a whole library of shapes for a display in one go
+    # form: displayID, n, optional seed (same seed, same shapes) and workers (processes)
+    displayID = int(float(request.form.get('displayID')))
+    n = int(request.form.get('n', 1))
+    seed = request.form.get('seed')
+    workers = int(request.form.get('workers', 1))
+    minDistance = request.form.get('minDistance')   # drop shapes closer than this to the library or each other
+    
+    newShapes, seed = create_shapes(displayID, n, None if seed in (None, '') else int(seed), workers,
+                                    None if minDistance in (None, '') else int(minDistance))
+    
+    response = jsonify(newShapes=json.dumps(newShapes), seed=seed)
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
 
-@app.get('/get_shape_IDs/<displayID>')
-def get_shape_IDs_HTTP(displayID):
-    IDs = get_shape_IDs(displayID)
-    response = jsonify(ShapeIDs=json.dumps(IDs))
+
+@app.post('/sequence')
+def sequence_HTTP():
+    # queue a timed sequence of shapes, JSON body (or a form with each field JSON encoded):
+    #   steps: [[shapeID, hold seconds], ...], shape 0 blanks the display
+    #   blank: optional seconds of blank display put after every shape
+    #   full: optional, rewrite every channel on each step
+    try:
+        params = request.get_json(silent=True) or {key: json.loads(val) for key, val in request.form.items()}
+    except ValueError:
+        params = None   # start_sequence answers with an error
+    response = jsonify(**start_sequence(params))
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
 
-@app.get('/set_piston/<displayID>/<piston>/<direction>')
-def set_piston_HTTP(displayID, piston, direction):
-    global activeDisplay, activePistons
-    # error checking on input
-    if not str(direction) == '0' and not str(direction) == '1':
-        response = jsonify(error='Direction must be 0 or 1')
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        return response
+@app.route('/sequence/<int:seqID>', methods = ['GET', 'DELETE'])
+def sequence_status_HTTP(seqID):
+    # GET for state and the onsets so far, DELETE to cancel
+    seq = sequencer.cancel(seqID) if request.method == 'DELETE' else sequencer.get(seqID)
+    response = jsonify(**seq.status()) if seq is not None else jsonify(error='no sequence ' + str(seqID))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
-    # First, get the info for the piston we want to change
-    # Check for special case of a request for the vacuum channel
-    print(type(piston))
-    print(piston)
-    if piston == "-1":
-        cmd = f"SELECT vacPLC, vacChan FROM displayPropsTable WHERE DisplayID='{displayID}'"
-    else:
-        cmd = f"SELECT PLC_ID, PLC_Chan FROM pistonAddressesTable WHERE DisplayID='{displayID}' AND piston='{piston}'"
-    res = dest.execute(cmd).fetchall()
-    if not res:
-        response = jsonify(error='Specified piston does not exist in db for this shape')
+@app.route('/metrics', methods = ['GET', 'DELETE'])
+def metrics_HTTP():
+    # ?format=prometheus for Prometheus' text format, DELETE starts the counts again
+    if request.method == 'DELETE':
+        metrics.reset()
+    if request.args.get('format') == 'prometheus':
+        return metrics.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    response = jsonify(**metrics_report())
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
+
+@app.route('/snapshots', methods = ['GET', 'POST'])
+def snapshots_HTTP():
+    # GET lists snapshots and what the snapshot thread is doing, POST starts one (label form field)
+    if request.method == 'POST':
+        snapshots.start(request.form.get('label', 'manual'))
+    response = jsonify(snapshots=snapshots.list(), **snapshots.status())
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
+
+@app.post('/snapshots/<name>/restore')
+def restore_HTTP(name):
+    try:
+        response = jsonify(**snapshots.restore(name))
+    except ValueError as e:
+        response = jsonify(error=str(e))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
+
+@app.get('/shape_preview/<shapeID>')
+def shape_preview_HTTP(shapeID):
+    # ?size= pixels (256) and ?format=png or svg. The key doubles as the ETag
+    try:
+        data, key, rendered = shape_preview(shapeID, request.args.get('size', 256), request.args.get('format', 'png'))
+    except ValueError as e:
+        response = jsonify(error=str(e))
         response.headers.add("Access-Control-Allow-Origin", "*")
         return response
-        
-    PLC_ID = res[0][0]
-    PLC_Chan = res[0][1]
-    print('plc: ' + str(PLC_ID) + ", chan: " + str(PLC_Chan) + ", direction: " + str(direction))
-    
-    val = 512 - 256 * int(direction)  #512 for down, 256 for up
-    
-    # Second, send the request to the PLC
-    client = connect_RS485()
-    if client:
-        result = client.write_register(address=PLC_Chan, value=val, unit=PLC_ID)
+    fmt = request.args.get('format', 'png')
+    if request.if_none_match.contains(key):
+        return Response(status=304, headers={'ETag': '"' + key + '"', "Access-Control-Allow-Origin": "*"})
+    return Response(data, 200, {'Content-Type': previewFormats[fmt], 'ETag': '"' + key + '"',
+                                'Cache-Control': 'no-cache', "Access-Control-Allow-Origin": "*"})
+
+@app.post('/shape_previews/<displayID>')
+def shape_previews_HTTP(displayID):
+    # render (or find cached) thumbnails for every shape on a display, form fields size (128) and format
+    try:
+        response = jsonify(**preview_display(displayID, int(request.form.get('size', 128)), request.form.get('format', 'png')))
+    except ValueError as e:
+        response = jsonify(error=str(e))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
-        if result.isError():
-            response = jsonify(error='PLC request failed')
-        else:
-            response = jsonify(PLCChan=json.dumps([res[0], direction]))
-        
-        client.close() # not clear that this does anything worthwhile
-        
-    else:
-        response = jsonify(error="Couldn't connect to the RS485 modem, using simulation mode...")
-    
-    # Third, tell the client how we did
+@app.get('/shape_search/<displayID>')
+def shape_search_HTTP(displayID):
+    response = jsonify(**shape_search(displayID, request.args))
     response.headers.add("Access-Control-Allow-Origin", "*")
-    activeShape = 0
-    # activeDisplay[piston] = direction
-    
-    activeDisplay = activeDisplay[:int(piston)] + str(direction) + activeDisplay[int(piston)+1:]
-    
-    broadcastDisplay()
     return response
 
+@app.get('/shape_duplicates/<displayID>')
+def shape_duplicates_HTTP(displayID):
+    # groups of shapes within maxDistance (default 0, exact repeats) of each other
+    groups = shape_index(displayID).duplicates(int(request.args.get('maxDistance', 0)))
+    response = jsonify(groups=json.dumps(groups))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
+@app.get('/export/<displayID>')
+def export_HTTP(displayID):
+    # the display and its shapes as an NDJSON download, see export_display
+    try:
+        lines = export_display(displayID)
+    except ValueError as e:
+        response = jsonify(error=str(e))
+    else:
+        response = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+        response.headers.add("Content-Disposition", "attachment; filename=display" + str(displayID) + ".ndjson")
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
+@app.post('/import')
+def import_HTTP():
+    # body is an export stream. It's spooled (to disk past 8 MB) before import_display takes dbLock,
+    # so a slow upload doesn't hold up every other writer
+    with tempfile.SpooledTemporaryFile(max_size=8 * 2**20) as body:
+        shutil.copyfileobj(request.stream, body, 2**16)
+        body.seek(0)
+        try:
+            response = jsonify(**import_display(body))
+        except ValueError as e:
+            response = jsonify(error=str(e))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
+@app.get('/get_display_IDs')
+def get_display_IDsHTTP():
+    response = jsonify(**display_IDs())
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
+@app.get('/rs485_status')
+def rs485_status_HTTP():
+    response = jsonify(**rs485_status())
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
+@app.get('/get_shape_IDs/<displayID>')
+def get_shape_IDs_HTTP(displayID):
+    IDs = get_shape_IDs(displayID)
+    response = jsonify(ShapeIDs=json.dumps(IDs))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
 
+@app.get('/set_piston/<displayID>/<piston>/<direction>')
+def set_piston_HTTP(displayID, piston, direction):
+    response = jsonify(**set_piston(displayID, piston, direction))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
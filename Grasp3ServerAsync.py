@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## asyncio serving mode for Grasp3Server2: the same routes, served as an ASGI app by Starlette
+#  websocket clients are asyncio tasks rather than threads, so idle monitor tabs cost next to nothing
+#  anything that talks to the RS485 buses runs on its own executor so the event loop never waits on serial
+#
+#  needs starlette, python-multipart and an ASGI server on top of Grasp3Server2's requirements:
+#    pip install starlette python-multipart uvicorn
+#    uvicorn Grasp3ServerAsync:app --host 0.0.0.0 --port 5000
+
+import asyncio, json, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.responses import Response, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+import Grasp3Server2 as g3
+
+
+serialExecutor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='serial')  # everything that touches the buses
+cors = {"Access-Control-Allow-Origin": "*"}
+
+
+async def on_serial(fn, *args):
+    # run fn on the serial executor
+    return await asyncio.get_running_loop().run_in_executor(serialExecutor, fn, *args)
+
+async def off_loop(fn, *args):
+    # run fn on the default executor, for db work and shape generation
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+class AsyncSocketClient(g3.SocketClient):
+    ## hub client that sends from an asyncio task on the server's event loop instead of its own thread
+    #  the hub can still be fed from any thread, _wake just pokes the task through the loop
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()   # hub.add is called from the websocket endpoint
+        self.ready = asyncio.Event()
+        self.task = self.loop.create_task(self._send_loop())
+
+    def _wake(self):
+        try:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:   # loop already closed, we're shutting down
+            pass
+
+    def close(self):
+        with self.cond:
+            self.alive = False
+            self._wake()
+
+    async def _send_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while True:
+                with self.cond:
+                    if not self.alive:
+                        return
+                    message = self._next()
+                if message is None:
+                    break
+                try:
+                    await self.ws.send_text(message)
+                except Exception:
+                    g3.hub.remove(self)
+                    try:
+                        await self.ws.close()   # ends the endpoint's receive loop too
+                    except Exception:
+                        pass
+                    return
+
+
+async def index(request):
+    return PlainTextResponse('hello world')
+
+
+async def display(request):
+    displayID = request.path_params['displayID']
+    if request.method == 'GET':
+        await off_loop(g3.select_display, displayID, request.path_params['passiveUpdate'])
+        geometry = await off_loop(g3.display_geometry, displayID)
+        status, body, headers = geometry.response(request.headers.get('if-none-match'), request.headers.get('accept-encoding'))
+        return Response(body, status, headers)
+
+    elif request.method == 'POST':
+        form = await request.form()
+        try:
+            args = [float(form.get(key)) for key in ('rMin', 'rAlwaysUp', 'rMax', 'pistonR', 'pistonPitch')]
+            dispID = await off_loop(g3.create_hex_array, *args)
+        except (ValueError, TypeError) as e:   # TypeError for a missing field
+            return JSONResponse(dict(error=str(e)), headers=cors)
+        return JSONResponse(dict(displayID=json.dumps(dispID)), headers=cors)
+
+    elif request.method == 'DELETE':
+        await off_loop(g3.delete_hex_array, displayID)
+        return PlainTextResponse("display deleted")
+
+
+async def display_preview(request):
+    try:
+        args = [float(request.query_params.get(key, default)) for key, default in
+                (('rMin', 5), ('rAlwaysUp', 7), ('rMax', 25), ('pistonR', 1.1), ('pistonPitch', 3.4))]
+        return JSONResponse(g3.preview_hex_array(*args), headers=cors)
+    except ValueError as e:
+        return JSONResponse(dict(error=str(e)), headers=cors)
+
+
+async def export(request):
+    displayID = request.path_params['displayID']
+    try:
+        lines = await off_loop(g3.export_display, displayID)
+    except ValueError as e:
+        return JSONResponse(dict(error=str(e)), headers=cors)
+    # starlette pulls a plain iterator on its threadpool, a chunk of rows at a time
+    return StreamingResponse(lines, media_type='application/x-ndjson',
+                             headers=dict(cors, **{'Content-Disposition': 'attachment; filename=display' + str(displayID) + '.ndjson'}))
+
+
+async def import_stream(request):
+    # spool the upload (to disk past 8 MB) and import it line by line off the loop
+    with tempfile.SpooledTemporaryFile(max_size=8 * 2**20) as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+        body.seek(0)
+        try:
+            result = await off_loop(g3.import_display, body)
+        except ValueError as e:
+            result = dict(error=str(e))
+    return JSONResponse(result, headers=cors)
+
+
+async def shape(request):
+    ID = request.path_params['ID']
+    if request.method == 'GET':
+        # ?full=1 rewrites every channel, ?format=packed returns the pistons as base64 bits
+        result = await on_serial(g3.show_shape, ID, request.query_params.get('full') == '1',
+                                 request.query_params.get('format', 'string'))
+        return JSONResponse(result, headers=cors)
+
+    elif request.method == 'POST':
+        form = await request.form()
+        newShape = await off_loop(g3.create_shape, float(form.get('displayID')))
+        return JSONResponse(dict(newShape=json.dumps(newShape)), headers=cors)
+
+    elif request.method == 'DELETE':
+        return PlainTextResponse("display deleted")
+
+
+async def shape_batch(request):
+    form = await request.form()
+    seed = form.get('seed')
+    minDistance = form.get('minDistance')
+    newShapes, seed = await off_loop(g3.create_shapes, int(float(form.get('displayID'))), int(form.get('n', 1)),
+                                     None if seed in (None, '') else int(seed), int(form.get('workers', 1)),
+                                     None if minDistance in (None, '') else int(minDistance))
+    return JSONResponse(dict(newShapes=json.dumps(newShapes), seed=seed), headers=cors)
+
+
+async def shape_preview(request):
+    # same as Grasp3Server2's /shape_preview
+    fmt = request.query_params.get('format', 'png')
+    try:
+        data, key, rendered = await off_loop(g3.shape_preview, request.path_params['shapeID'],
+                                             request.query_params.get('size', 256), fmt)
+    except ValueError as e:
+        return JSONResponse(dict(error=str(e)), headers=cors)
+    headers = dict(cors, ETag='"' + key + '"')
+    if '"' + key + '"' in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type=g3.previewFormats[fmt], headers=dict(headers, **{'Cache-Control': 'no-cache'}))
+
+
+async def shape_previews(request):
+    form = await request.form()
+    try:
+        result = await off_loop(g3.preview_display, request.path_params['displayID'], int(form.get('size', 128)),
+                                form.get('format', 'png'))
+    except ValueError as e:
+        result = dict(error=str(e))
+    return JSONResponse(result, headers=cors)
+
+
+async def shape_search(request):
+    displayID = request.path_params['displayID']
+    return JSONResponse(await off_loop(g3.shape_search, displayID, dict(request.query_params)), headers=cors)
+
+
+async def shape_duplicates(request):
+    index = await off_loop(g3.shape_index, request.path_params['displayID'])
+    groups = await off_loop(index.duplicates, int(request.query_params.get('maxDistance', 0)))
+    return JSONResponse(dict(groups=json.dumps(groups)), headers=cors)
+
+
+async def snapshots(request):
+    # same as Grasp3Server2's /snapshots
+    if request.method == 'POST':
+        form = await request.form()
+        g3.snapshots.start(form.get('label', 'manual'))
+    return JSONResponse(dict(snapshots=g3.snapshots.list(), **g3.snapshots.status()), headers=cors)
+
+
+async def restore(request):
+    # takes a safety snapshot and then holds the writers, so it goes off the loop
+    try:
+        result = await off_loop(g3.snapshots.restore, request.path_params['name'])
+    except ValueError as e:
+        result = dict(error=str(e))
+    return JSONResponse(result, headers=cors)
+
+
+async def sequence(request):
+    # same body as Grasp3Server2's /sequence, JSON or a form of JSON encoded fields
+    try:
+        if request.headers.get('content-type', '').startswith('application/json'):
+            params = await request.json()
+        else:
+            params = {key: json.loads(val) for key, val in (await request.form()).items()}
+    except ValueError:
+        params = None   # start_sequence answers with an error
+    return JSONResponse(await off_loop(g3.start_sequence, params), headers=cors)
+
+
+async def sequence_status(request):
+    seqID = request.path_params['seqID']
+    seq = g3.sequencer.cancel(seqID) if request.method == 'DELETE' else g3.sequencer.get(seqID)
+    return JSONResponse(seq.status() if seq is not None else dict(error='no sequence ' + str(seqID)), headers=cors)
+
+
+async def get_display_IDs(request):
+    # opens the buses if they aren't already, so it goes on the serial executor
+    return JSONResponse(await on_serial(g3.display_IDs), headers=cors)
+
+
+async def get_shape_IDs(request):
+    IDs = await off_loop(g3.get_shape_IDs, request.path_params['displayID'])
+    return JSONResponse(dict(ShapeIDs=json.dumps(IDs)), headers=cors)
+
+
+async def set_piston(request):
+    p = request.path_params
+    # coalesced toggles sit out their window and the coalescer's own thread does the writing,
+    # so they wait on the default executor rather than tie up the serial one
+    run = off_loop if g3.toggleWindow > 0 else on_serial
+    return JSONResponse(await run(g3.set_piston, p['displayID'], p['piston'], p['direction']), headers=cors)
+
+
+async def rs485_status(request):
+    return JSONResponse(g3.rs485_status(), headers=cors)
+
+
+async def metrics(request):
+    # same as Grasp3Server2's /metrics, ?format=prometheus for Prometheus' text format
+    if request.method == 'DELETE':
+        g3.metrics.reset()
+    if request.query_params.get('format') == 'prometheus':
+        return PlainTextResponse(g3.metrics.prometheus(), media_type='text/plain; version=0.0.4')
+    return JSONResponse(g3.metrics_report(), headers=cors)
+
+
+async def echo(websocket):
+    # same behaviour as Grasp3Server2.echo, ?format=packed and ?protocol=2 included
+    await websocket.accept()
+    protocol = 2 if websocket.query_params.get('protocol') == '2' else 1
+    fmt = 'packed' if websocket.query_params.get('format') == 'packed' else 'string'
+    client = g3.hub.add(websocket, fmt, protocol, cls=AsyncSocketClient)
+    g3.welcome(client)
+
+    try:
+        while client.alive:
+            data = await websocket.receive_text()
+            g3.socket_message(client, data)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        g3.hub.remove(client)
+
+
+app = Starlette(routes=[
+    Route('/', index),
+    WebSocketRoute('/', echo),
+    Route('/display/{displayID}/{passiveUpdate}', display, methods=['GET', 'POST', 'DELETE']),
+    Route('/display_preview', display_preview),
+    Route('/shape/{ID}', shape, methods=['GET', 'POST', 'DELETE']),
+    Route('/shape_batch', shape_batch, methods=['POST']),
+    Route('/export/{displayID}', export),
+    Route('/import', import_stream, methods=['POST']),
+    Route('/shape_preview/{shapeID}', shape_preview),
+    Route('/shape_previews/{displayID}', shape_previews, methods=['POST']),
+    Route('/shape_search/{displayID}', shape_search),
+    Route('/shape_duplicates/{displayID}', shape_duplicates),
+    Route('/snapshots', snapshots, methods=['GET', 'POST']),
+    Route('/snapshots/{name}/restore', restore, methods=['POST']),
+    Route('/sequence', sequence, methods=['POST']),
+    Route('/sequence/{seqID:int}', sequence_status, methods=['GET', 'DELETE']),
+    Route('/get_display_IDs', get_display_IDs),
+    Route('/get_shape_IDs/{displayID}', get_shape_IDs),
+    Route('/set_piston/{displayID}/{piston}/{direction}', set_piston),
+    Route('/rs485_status', rs485_status),
+    Route('/metrics', metrics, methods=['GET', 'DELETE']),
+])
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
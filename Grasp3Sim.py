@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## simulated RS485 converter and PLCs, standing in for pymodbus' ModbusSerialClient when there's no hardware
+#  the PLCs follow the register semantics Grasp3Server2 relies on:
+#    address 1 = 1792 sets every channel high, 2048 sets every channel low
+#    channel registers 1..32 = 256 for up, 512 for down
+#    register 254 = baud, 3 for 9600 and 4 for 19200, used from the next frame on
+#  frames take as long as they would on the wire (10 bits a byte at 8N1, 3.5 character gap, plus
+#  the PLC's turnaround latency) and a bus carries one frame at a time, like real half duplex RS485
+#
+#  Grasp3Server2 uses it when GRASP3_SIM is set, e.g.
+#    GRASP3_SIM="plcs=8,latency=0.005,errorRate=0.01" python Grasp3Server2.py
+#  options (all optional, comma separated key=value):
+#    plcs       number of PLCs answering on each bus, units 1..plcs (0, the default, means any unit answers)
+#    plcBaud    baud the PLCs start at (19200)
+#    latency    seconds a PLC takes to turn a request around (0.005)
+#    errorRate  fraction of frames that get no answer (0)
+#    noBulk     PLC units that answer function 16 with an illegal function exception, e.g. noBulk=2+5
+#    timeScale  1 sleeps for the simulated frame times, 0 doesn't sleep and only adds them up (1)
+#    seed       seed for the error injection
+
+import threading, time, random
+import numpy as np
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.register_write_message import WriteSingleRegisterResponse, WriteMultipleRegistersResponse
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+
+
+chansEach = 32
+baudCodes = {3: 9600, 4: 19200}   # register 254 values
+
+simBuses = {}      # port -> SimBus, shared by every client opened on that port so PLC state survives reconnects
+simBusesLock = threading.Lock()
+
+
+def parse_config(text):
+    # 'plcs=8,latency=0.005' -> dict of options for SimBus, an empty string or '1' gives the defaults
+    config = {}
+    for item in (text or '').split(','):
+        if '=' not in item:
+            continue
+        key, val = [part.strip() for part in item.split('=', 1)]
+        if key == 'noBulk':
+            config[key] = set([int(unit) for unit in val.split('+') if unit])
+        elif key in ('plcs', 'plcBaud', 'seed'):
+            config[key] = int(val)
+        else:
+            config[key] = float(val)
+    return config
+
+
+class SimPLC:
+    ## one PLC's registers and pistons
+
+    def __init__(self, unit, baud=19200, bulk=True):
+        self.unit = unit
+        self.baud = baud
+        self.bulk = bulk
+        self.up = np.zeros(chansEach+1, dtype=bool)   # indexed by channel, 0 unused
+        self.writes = 0
+
+    def write(self, address, value):
+        # apply one register write, None if it took or the modbus exception code if not
+        if address == 254:
+            if value not in baudCodes:
+                return 3   # illegal data value
+            self.baud = baudCodes[value]
+        elif address == 1 and value in (1792, 2048):
+            self.up[1:] = value == 1792
+        elif 1 <= address <= chansEach and value in (256, 512):
+            self.up[address] = value == 256
+        elif 1 <= address <= chansEach:
+            return 3
+        else:
+            return 2   # illegal data address
+        self.writes += 1
+        return None
+
+    def read(self, address):
+        if address == 254:
+            return {baud: code for code, baud in baudCodes.items()}[self.baud]
+        if 1 <= address <= chansEach:
+            return 256 if self.up[address] else 512
+        return None
+
+
+class SimBus:
+    ## the PLCs hanging off one converter, plus what the bus has been doing
+
+    def __init__(self, port, plcs=0, plcBaud=19200, latency=0.005, errorRate=0., noBulk=(), timeScale=1., seed=None):
+        self.port = port
+        self.plcs = plcs
+        self.plcBaud = plcBaud
+        self.latency = latency
+        self.errorRate = errorRate
+        self.noBulk = set(noBulk)
+        self.timeScale = timeScale
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()   # one frame on the wire at a time
+        self.PLCs = {}
+        self.unplugged = False
+        self.frames = 0
+        self.timeouts = 0
+        self.busySeconds = 0.   # simulated time the bus spent on frames
+
+    def plc(self, unit):
+        # the PLC answering to unit, or None if nothing is there
+        if unit < 1 or unit > 247 or (self.plcs and unit > self.plcs):
+            return None
+        if unit not in self.PLCs:
+            self.PLCs[unit] = SimPLC(unit, self.plcBaud, unit not in self.noBulk)
+        return self.PLCs[unit]
+
+    def pistons(self, unit):
+        # channel states of a PLC, True for up, index 0 unused
+        return self.plc(unit).up.copy()
+
+    def unplug(self):
+        # the converter goes away: writes on open clients raise and new clients can't connect
+        self.unplugged = True
+
+    def plug_in(self):
+        self.unplugged = False
+
+    def frame_time(self, nRequest, nResponse, baud):
+        # seconds on the wire for a request and its response, with the PLC's turnaround in between
+        char = 10. / baud
+        return (nRequest + nResponse + 7) * char + self.latency
+
+    def transact(self, baud, unit, nRequest, nResponse, action):
+        ## put one frame on the bus, action(plc) does the work and returns the response
+        #  a PLC that isn't there, is at another baud or loses the frame leaves the client waiting
+        #  for a timeout, which is the latency plus the request time here rather than pymodbus' 3 s
+        with self.lock:
+            if self.unplugged:
+                raise ConnectionError('simulated converter unplugged')
+            plc = self.plc(unit)
+            lost = plc is None or plc.baud != baud or (self.errorRate and self.rng.random() < self.errorRate)
+            seconds = self.frame_time(nRequest, 0 if lost else nResponse, baud)
+            self.frames += 1
+            self.busySeconds += seconds
+            if self.timeScale:
+                time.sleep(seconds * self.timeScale)
+            if lost:
+                self.timeouts += 1
+                return ModbusIOException('No response from simulated unit ' + str(unit))
+            return action(plc)
+
+    def status(self):
+        return dict(port=self.port, frames=self.frames, timeouts=self.timeouts, busySeconds=self.busySeconds,
+                    PLCs=len(self.PLCs), unplugged=self.unplugged)
+
+
+def sim_bus(port, **config):
+    # the SimBus for a port, made with config the first time it's asked for
+    with simBusesLock:
+        if port not in simBuses:
+            simBuses[port] = SimBus(port, **config)
+        return simBuses[port]
+
+def reset():
+    # forget every simulated bus and PLC
+    with simBusesLock:
+        simBuses.clear()
+
+
+class SimClient:
+    ## drop-in for the parts of pymodbus' ModbusSerialClient that Grasp3Server2 uses
+
+    def __init__(self, method='rtu', port=None, baudrate=19200, bytesize=8, parity='N', stopbits=1, **config):
+        self.port = port
+        self.baudrate = baudrate
+        self.bus = sim_bus(port, **config)
+        self.open = False
+
+    def connect(self):
+        self.open = not self.bus.unplugged
+        return self.open
+
+    def is_socket_open(self):
+        return self.open and not self.bus.unplugged
+
+    def close(self):
+        self.open = False
+
+    def _unit(self, kwargs):
+        return int(kwargs.get('unit', kwargs.get('slave', 0)))
+
+    def _check(self):
+        if not self.open:
+            raise ConnectionError('simulated port not open')
+
+    def write_register(self, address, value, **kwargs):
+        # function 6, 8 byte request and echo
+        self._check()
+        unit = self._unit(kwargs)
+
+        def action(plc):
+            code = plc.write(int(address), int(value))
+            if code is not None:
+                return ExceptionResponse(6, code, unit=unit)
+            return WriteSingleRegisterResponse(address, value, unit=unit)
+        return self.bus.transact(self.baudrate, unit, 8, 8, action)
+
+    def write_registers(self, address, values, **kwargs):
+        # function 16, 9 + 2n byte request and 8 byte answer. registers are written in order and
+        # the first one the PLC won't take stops the write, like a PLC validating as it goes
+        self._check()
+        unit = self._unit(kwargs)
+        values = [int(v) for v in values]
+
+        def action(plc):
+            if not plc.bulk:
+                return ExceptionResponse(16, 1, unit=unit)   # illegal function
+            for i, value in enumerate(values):
+                code = plc.write(int(address) + i, value)
+                if code is not None:
+                    return ExceptionResponse(16, code, unit=unit)
+            return WriteMultipleRegistersResponse(address, len(values), unit=unit)
+        return self.bus.transact(self.baudrate, unit, 9 + 2*len(values), 8, action)
+
+    def read_holding_registers(self, address, count=1, **kwargs):
+        # function 3, handy for checking what the simulated PLCs are doing
+        self._check()
+        unit = self._unit(kwargs)
+
+        def action(plc):
+            registers = [plc.read(int(address) + i) for i in range(count)]
+            if None in registers:
+                return ExceptionResponse(3, 2, unit=unit)
+            return ReadHoldingRegistersResponse(registers, unit=unit)
+        return self.bus.transact(self.baudrate, unit, 8, 5 + 2*count, action)